@@ -0,0 +1,259 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from plash import metadata, trace
+from plash.eval import get_hint_values, hint, remove_hint_values
+from plash.utils import (color, die, get_plash_data, hashstr, info, lock,
+                         mkdtemp, nodepath_or_die, plash_map)
+
+
+def get_layers(script):
+    'split an evaluated build script in its image and its layers'
+    hints = dict(get_hint_values(script))
+    image_hint = hints.get('image')
+    if not image_hint:
+        die('no image specified', exit=2)
+
+    # split the script in its layers
+    layers = script.split(hint('layer') + '\n')
+    layers = [remove_hint_values(l) for l in layers]
+    layers = [l for l in layers if l]
+    return image_hint, layers
+
+
+def get_cache_key(container, layer):
+    'the map key of a layer built on top of a container'
+    return hashstr(b':'.join([container.encode(), layer.encode()]))
+
+
+def get_layer_script(nodepath):
+    'the build script of a layer if it was built by `plash build`'
+    try:
+        with open(os.path.join(nodepath, '_data', 'script')) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def save_layer_script(nodepath, layer):
+    'record the script of a layer, so an export can tell it'
+    script_file = os.path.join(nodepath, '_data', 'script')
+    with open(script_file + '.tmp', 'w') as f:
+        f.write(layer)
+    os.rename(script_file + '.tmp', script_file)
+
+
+def build_layer(container, layer):
+    '''
+    Build a layer on top of a container or take it from the build cache.
+    Exits the program if the build fails.
+    '''
+    cache_key = get_cache_key(container, layer)
+    with trace.span(
+            'layer', parent=container, cache_key=cache_key,
+            script=layer[:200]) as details:
+        next_container = plash_map(cache_key)
+        if next_container:
+            details.update(cache='hit', container=next_container)
+            return next_container
+
+        def on_wait():
+            details['cache'] = 'waited'
+            info('--: waiting for another build')
+
+        # only one process builds a layer at a time, the others wait for it
+        with lock(cache_key, on_wait=on_wait):
+            next_container = plash_map(cache_key)
+            if not next_container:
+                details['cache'] = 'miss'
+
+                # build and cache it
+                started = time.monotonic()
+                p = subprocess.Popen(
+                    ['plash-create', container, 'env', '-i', 'sh', '-l'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE)
+
+                # for some reason in ubuntu the path is not exported
+                # in a way this is a hack and should be fixed in ubuntu
+                p.stdin.write(b'export PATH\n')
+
+                p.stdin.write(b'set -ex\n')
+                p.stdin.write(layer.encode())
+                p.stdin.close()
+                next_container = p.stdout.read().decode().strip('\n')
+                exit = p.wait()
+                if exit:
+                    # plash-create already prints a nice error message
+                    sys.exit(1)
+                nodepath = nodepath_or_die(next_container)
+                save_layer_script(nodepath, layer)
+                metadata.save_build_seconds(next_container, nodepath,
+                                            time.monotonic() - started)
+                plash_map(cache_key, next_container)
+                info('--:')
+        details['container'] = next_container
+    return next_container
+
+
+def build(script):
+    '''
+    Build the container described by an evaluated build script and return its
+    container id. Each layer is cached with `plash map`.
+    '''
+    current_container, layers = get_layers(script)
+    nodepath_or_die(current_container)
+    os.environ['PS4'] = color('--> ', 4)
+    with trace.span('build', image=current_container,
+                    layers=len(layers)) as details:
+        for layer in layers:
+            current_container = build_layer(current_container, layer)
+        details['container'] = current_container
+    return current_container
+
+
+def build_many(scripts, jobs):
+    '''
+    Build the containers of many evaluated build scripts. Layers shared by
+    multiple scripts are built once, independent layers are built in parallel
+    by up to `jobs` workers. Returns the container ids in the order of the
+    scripts.
+    '''
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    # a node of the build graph is a tuple of the image and its layers
+    targets = []
+    children = {}
+    for script in scripts:
+        image, layers = get_layers(script)
+        nodepath_or_die(image)
+        node = (image, )
+        for layer in layers:
+            child = node + (layer, )
+            children.setdefault(node, {})[child] = None
+            node = child
+        targets.append(node)
+
+    os.environ['PS4'] = color('--> ', 4)
+    built = {target[:1]: target[0] for target in targets}
+    with trace.span('build-many', targets=len(targets),
+                    jobs=jobs), ThreadPoolExecutor(jobs) as executor:
+
+        def submit_children(node):
+            return {
+                executor.submit(build_layer, built[node], child[-1]): child
+                for child in children.get(node, ())
+            }
+
+        pending = {}
+        for root in list(built):
+            pending.update(submit_children(root))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = pending.pop(future)
+                try:
+                    built[node] = future.result()
+                except SystemExit:
+                    # let running builds finish but don't start new ones
+                    for future in pending:
+                        future.cancel()
+                    raise
+                pending.update(submit_children(node))
+
+    return [built[target] for target in targets]
+
+
+def get_code_stamp():
+    'changes when the code that evaluates macros changes'
+    import plash
+    libdir = os.path.dirname(plash.__file__)
+    macros_dir = os.path.join(libdir, 'macros')
+    files = [os.path.join(libdir, 'eval.py')] + [
+        os.path.join(macros_dir, f) for f in os.listdir(macros_dir)
+        if f.endswith('.py')
+    ]
+    return max(os.stat(f).st_mtime_ns for f in files)
+
+
+def check_inputs(inputs):
+    'check if the inputs recorded while evaluating did not change'
+    for kind, *args in inputs:
+        if kind == 'file':
+            fname, digest = args
+            try:
+                with open(fname, 'rb') as f:
+                    if hashstr(f.read()) != digest:
+                        return False
+            except OSError:
+                return False
+        elif kind == 'env':
+            env, value = args
+            if os.environ.get(env) != value:
+                return False
+        elif kind == 'hash-path':
+            paths, digest = args
+            from plash.macros.common import HashPaths
+            try:
+                if HashPaths()(*paths) != ': hash: {}'.format(digest):
+                    return False
+            except OSError:
+                return False
+        elif kind == 'map':
+            map_key, container = args
+            if plash_map(map_key) != container:
+                return False
+        else:
+            return False
+    return True
+
+
+def build_cached(key, evaluate):
+    '''
+    Build the evaluated build script returned by `evaluate` and return the
+    container id and the hint values. If everything the evaluation depended on
+    is unchanged since the last call with the same `key`, skip evaluating and
+    building and return the cached result.
+    '''
+    from plash.eval import get_hint_values, recording_inputs
+    key = [os.getcwd(), get_code_stamp()] + key
+    cache_file = os.path.join(get_plash_data(), 'cache', 'build',
+                              hashstr(json.dumps(key).encode()))
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+    with trace.span('build-cache', key=key) as details:
+        hit = (cached and cached['key'] == key and os.path.exists(
+            os.path.join(get_plash_data(), 'index', cached['container']))
+               and check_inputs(cached['inputs']))
+        details['cache'] = 'hit' if hit else 'miss'
+    if hit:
+        return cached['container'], cached['hints']
+
+    # record the inputs of this evaluation and the files it evaluates, other
+    # builds it runs record their own
+    with recording_inputs() as inputs:
+        with trace.span('eval'):
+            script = evaluate()
+    container = build(script)
+    hints = get_hint_values(script)
+
+    if ['volatile'] not in inputs:
+        tmpdir = mkdtemp()
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(os.path.join(tmpdir, 'cache'), 'w') as f:
+            json.dump({
+                'key': key,
+                'inputs': inputs,
+                'container': container,
+                'hints': hints
+            }, f)
+        os.rename(os.path.join(tmpdir, 'cache'), cache_file)
+        shutil.rmtree(tmpdir)
+    return container, hints
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import stat
+from os.path import join
+
+from plash.utils import get_plash_data
+
+# linking smaller files would not save much more than a block
+DEDUP_MIN_SIZE = 4096
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_enabled():
+    'deduplication at `plash add-layer` is enabled with config/dedup'
+    return os.path.exists(join(get_plash_data(), 'config', 'dedup'))
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def dedup_file(path, store):
+    '''
+    Hardlink a file to the copy in the dedup store with the same content and
+    metadata, or put it there if there is none. Returns the freed bytes.
+    '''
+    st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode) or st.st_size < DEDUP_MIN_SIZE:
+        return 0
+
+    # hardlinks share all metadata, don't change how any file looks like
+    if os.listxattr(path, follow_symlinks=False):
+        return 0
+    key = '{}-{:o}-{}-{}-{}'.format(
+        hash_file(path), st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns)
+    stored = join(store, key[:2], key)
+    os.makedirs(join(store, key[:2]), exist_ok=True)
+
+    try:
+        os.link(path, stored)
+        return 0  # this is the first copy we see
+    except FileExistsError:
+        pass
+    if os.lstat(stored).st_ino == st.st_ino:
+        return 0  # already deduplicated
+
+    # atomically replace the file with a link to the stored one
+    tmp = path + '.plash-dedup'
+    os.link(stored, tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+    return st.st_size if st.st_nlink == 1 else 0
+
+
+def dedup_dir(dir):
+    '''
+    Deduplicate all files in a directory against the dedup store in
+    $PLASH_DATA/dedup. Files that can't be linked are skipped. Returns the
+    freed bytes.
+    '''
+    store = join(get_plash_data(), 'dedup')
+    freed = 0
+    for dirpath, dirnames, filenames in os.walk(dir):
+        for filename in filenames:
+            try:
+                freed += dedup_file(join(dirpath, filename), store)
+            except OSError:
+                continue
+    return freed
+
+
+def dedup_node(nodepath):
+    '''
+    Deduplicate the files of a layer once, returns the freed bytes.
+    '''
+    marker = join(nodepath, '_data', 'deduped')
+    if os.path.exists(marker):
+        return 0
+    freed = dedup_dir(join(nodepath, '_data', 'root'))
+    with open(marker, 'w'):
+        pass
+    return freed
+
+
+def remove_unused():
+    '''
+    Remove files from the dedup store that no layer links to anymore, returns
+    the freed bytes.
+    '''
+    store = join(get_plash_data(), 'dedup')
+    freed = 0
+    for dirpath, dirnames, filenames in os.walk(store):
+        for filename in filenames:
+            stored = join(dirpath, filename)
+            try:
+                st = os.lstat(stored)
+                if st.st_nlink == 1:
+                    os.unlink(stored)
+                    freed += st.st_size
+            except FileNotFoundError:
+                continue
+    return freed
@@ -0,0 +1,414 @@
+'''
+Sending containers layer by layer between build hosts. A layer is identified
+by its chain hash, the hash of its own content hash and the chain hash of its
+parent layer, so equal chain hashes mean equal containers. The content hash is
+the sha256 of the layer's uncompressed tar stream when it was exported the
+first time. It is recorded in the layer and travels with it, so exporting a
+layer again or from the importing host does not change it. Importing hosts
+check that the received tar stream has the content hash, so a layer that does
+not tar to its recorded content hash anymore can not be exported.
+
+An export stream starts with the line "plash-layers 1" and a JSON line telling
+the count of layers. Every layer, the lowest first, has a JSON line with its
+hashes, the script it was built with and its map keys. If its data is sent, the
+compressed tar stream follows in frames, each a line with the length of the
+frame followed by its bytes, ended by a frame of length zero. Importing hosts
+map the chain hashes of their layers to the keys layer-CHAINHASH.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from os.path import basename, join
+
+from plash import trace
+from plash.build import get_cache_key, get_layer_script, save_layer_script
+from plash.extract import CHUNK_SIZE, find_gnu_tar, read_chunks
+from plash.gc import BUILD_CACHE_KEY
+from plash.layout import allocate_ids, get_ancestors
+from plash.utils import die, get_plash_data, plash_map
+
+MAGIC = b'plash-layers 1\n'
+
+# external compressors by preference, the stream is not compressed without one
+COMPRESSORS = [['zstd', '-q', '-c', '-T0'], ['pigz', '-c'], ['gzip', '-c']]
+
+
+def get_layer_key(chain_hash):
+    return 'layer-{}'.format(chain_hash)
+
+
+def get_chain_hash(parent_chain_hash, content_hash):
+    return hashlib.sha256('{}:{}'.format(parent_chain_hash,
+                                         content_hash).encode()).hexdigest()
+
+
+def get_layers(nodepath):
+    'the nodepaths of a container and its parents, lowest first'
+    return get_ancestors(nodepath)[::-1]
+
+
+def get_map_keys():
+    'return a dict of the containers and the map keys pointing to them'
+    from plash import metadata
+    if metadata.is_enabled():
+        maps = metadata.get_maps()
+    else:
+        map_dir = join(get_plash_data(), 'map')
+        maps = {}
+        for key in os.listdir(map_dir):
+            try:
+                maps[key] = basename(os.readlink(join(map_dir, key)))
+            except OSError:
+                continue
+    keys = {}
+    for key, container in maps.items():
+        keys.setdefault(container, []).append(key)
+    return keys
+
+
+def get_known():
+    'the chain hashes of all layers that were exported or imported here'
+    prefix = get_layer_key('')
+    return sorted(key[len(prefix):]
+                  for keys in get_map_keys().values() for key in keys
+                  if key.startswith(prefix))
+
+
+def read_hashes(nodepath):
+    try:
+        with open(join(nodepath, '_data', 'hashes.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_hashes(nodepath, hashes):
+    hashes_file = join(nodepath, '_data', 'hashes.json')
+    with open(hashes_file + '.tmp', 'w') as f:
+        json.dump(hashes, f)
+    os.rename(hashes_file + '.tmp', hashes_file)
+
+
+def open_tar(root):
+    '''
+    Return a process writing the files of a layer as uncompressed tar stream
+    to its stdout. The stream only depends on the files, their metadata and
+    the tar implementation.
+    '''
+    tar = find_gnu_tar()
+    if tar:
+        return subprocess.Popen([
+            tar, '-c', '-f', '-', '--sort=name', '--numeric-owner',
+            '--xattrs', '--xattrs-include=*',
+            '--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,'
+            'delete=ctime', '-C', root, '.'
+        ], stdout=subprocess.PIPE)
+    return TarFileProcess(root)
+
+
+class TarFileProcess:
+    'like a tar process, but with the tarfile module in a thread'
+
+    def __init__(self, root):
+        import tarfile
+        read_fd, write_fd = os.pipe()
+        self.stdout = open(read_fd, 'rb')
+        self.returncode = None
+        self.error = None
+
+        def anonymous(tarinfo):
+            tarinfo.uname = tarinfo.gname = ''
+            return tarinfo
+
+        def run():
+            try:
+                with open(write_fd, 'wb') as f, tarfile.open(
+                        fileobj=f, mode='w|',
+                        format=tarfile.PAX_FORMAT) as t:
+                    # directory entries are added sorted
+                    t.add(root, arcname='.', filter=anonymous)
+            except Exception as exc:
+                self.error = exc
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        self.thread.join()
+        self.returncode = 1 if self.error else 0
+        return self.returncode
+
+
+def finish_tar(process):
+    if process.wait():
+        die('creating tar stream failed with exit status {}'.format(
+            process.returncode))
+
+
+def compute_content_hash(nodepath):
+    content_hash = hashlib.sha256()
+    process = open_tar(join(nodepath, '_data', 'root'))
+    for chunk in read_chunks(process.stdout):
+        content_hash.update(chunk)
+    finish_tar(process)
+    return content_hash.hexdigest()
+
+
+def get_hashes(layers):
+    '''
+    Return the content and chain hash of each layer, hashing the layers
+    exported for the first time and recording their hashes.
+    '''
+    hashes = []
+    parent_chain_hash = ''
+    for nodepath in layers:
+        recorded = read_hashes(nodepath)
+        if recorded and recorded['parent'] == parent_chain_hash:
+            content_hash = recorded['content']
+        else:
+            with trace.span('hash-layer', container=basename(nodepath)):
+                content_hash = compute_content_hash(nodepath)
+        chain_hash = get_chain_hash(parent_chain_hash, content_hash)
+        hashes_record = {
+            'content': content_hash,
+            'chain': chain_hash,
+            'parent': parent_chain_hash
+        }
+        if recorded != hashes_record:
+            try:
+                save_hashes(nodepath, hashes_record)
+            except OSError:
+                pass  # we will hash it again next time
+        if plash_map(get_layer_key(chain_hash)) != basename(nodepath):
+            plash_map(get_layer_key(chain_hash), basename(nodepath))
+        hashes.append((content_hash, chain_hash))
+        parent_chain_hash = chain_hash
+    return hashes
+
+
+def find_compressor():
+    for cmd in COMPRESSORS:
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+
+def write_frames(chunks, out):
+    for chunk in chunks:
+        out.write(b'%d\n' % len(chunk))
+        out.write(chunk)
+    out.write(b'0\n')
+
+
+def hashed(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def send_layer_data(nodepath, out):
+    '''
+    Write the compressed tar stream of a layer in frames to `out`. Returns
+    the sha256 of the uncompressed tar stream.
+    '''
+    digest = hashlib.sha256()
+    process = open_tar(join(nodepath, '_data', 'root'))
+    compressor_cmd = find_compressor()
+    if not compressor_cmd:
+        write_frames(hashed(read_chunks(process.stdout), digest), out)
+        finish_tar(process)
+        return digest.hexdigest()
+
+    compressor = subprocess.Popen(
+        compressor_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            for chunk in hashed(read_chunks(process.stdout), digest):
+                compressor.stdin.write(chunk)
+        except BrokenPipeError:
+            pass  # the compressor failed, its exit status tells
+        finally:
+            compressor.stdin.close()
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    write_frames(read_chunks(compressor.stdout), out)
+    thread.join()
+    if compressor.wait():
+        die('compressing with {} failed with exit status {}'.format(
+            compressor_cmd[0], compressor.returncode))
+    finish_tar(process)
+    return digest.hexdigest()
+
+
+def export(nodepath, out, known=()):
+    '''
+    Write an export stream of the container at nodepath to the binary file
+    `out`. The data of layers with a chain hash in `known` is left out.
+    '''
+    layers = get_layers(nodepath)
+    hashes = get_hashes(layers)
+    map_keys = get_map_keys()
+    known = set(known)
+    out.write(MAGIC)
+    out.write(json.dumps({'layers': len(layers)}).encode() + b'\n')
+    for nodepath, (content_hash, chain_hash) in zip(layers, hashes):
+        send_data = chain_hash not in known
+        keys = [
+            key for key in map_keys.get(basename(nodepath), [])
+            if not BUILD_CACHE_KEY.fullmatch(key)
+        ]
+        header = {
+            'content_hash': content_hash,
+            'chain_hash': chain_hash,
+            'script': get_layer_script(nodepath),
+            'maps': keys,
+            'data': send_data,
+        }
+        out.write(json.dumps(header).encode() + b'\n')
+        if send_data:
+            with trace.span('export-layer', container=basename(nodepath)):
+                sent_hash = send_layer_data(nodepath, out)
+            if sent_hash != content_hash:
+                # the importing host rejects it, hash it again next time
+                try:
+                    os.unlink(join(nodepath, '_data', 'hashes.json'))
+                except FileNotFoundError:
+                    pass
+                die('layer {} changed since its content hash was recorded, '
+                    'export it again'.format(basename(nodepath)))
+    out.flush()
+
+
+class FrameReader:
+    'reads the data of one layer from an export stream'
+
+    def __init__(self, src):
+        self.src = src
+        self.left = 0
+        self.done = False
+
+    def read_frame_header(self):
+        line = self.src.readline()
+        try:
+            self.left = int(line)
+        except ValueError:
+            die('export stream is corrupted or truncated')
+        if not self.left:
+            self.done = True
+
+    def read(self, size=-1):
+        if size < 0:
+            size = CHUNK_SIZE
+        data = b''
+        while len(data) < size and not self.done:
+            if not self.left:
+                self.read_frame_header()
+                continue
+            chunk = self.src.read(min(self.left, size - len(data)))
+            if not chunk:
+                die('export stream is truncated')
+            self.left -= len(chunk)
+            data += chunk
+        return data
+
+    def drain(self):
+        for _ in read_chunks(self):
+            pass
+
+
+def read_json_line(src):
+    line = src.readline()
+    try:
+        return json.loads(line.decode())
+    except ValueError:
+        die('export stream is corrupted or truncated')
+
+
+def import_(src):
+    '''
+    Read an export stream from the binary file `src` and add the layers that
+    are not here yet. Returns the container id of the top layer.
+    '''
+    from plash.extract import extract_tar
+    from plash.utils import add_layer, mkdtemp, nodepath_or_die
+
+    if src.read(len(MAGIC)) != MAGIC:
+        die('not a stream written by `plash export-layers`')
+    count = read_json_line(src)['layers']
+    container = '0'
+    parent_chain_hash = ''
+    reserved_ids = []
+    for index in range(count):
+        header = read_json_line(src)
+        chain_hash = header['chain_hash']
+        if get_chain_hash(parent_chain_hash,
+                          header['content_hash']) != chain_hash:
+            die('export stream is corrupted')
+        parent = container
+        container = plash_map(get_layer_key(chain_hash))
+        reader = FrameReader(src)
+        if container:
+            if header['data']:
+                reader.drain()
+            print('plash: layer {} is here as {}'.format(
+                chain_hash[:12], container), file=sys.stderr)
+        elif not header['data']:
+            die('layer {} was left out but is not here, export it without '
+                '--known'.format(chain_hash[:12]))
+        else:
+            rootfs = mkdtemp()
+            content_hash = hashlib.sha256()
+            with trace.span('import-layer', parent=parent) as details:
+                stages = extract_tar(
+                    reader,
+                    rootfs,
+                    source='received',
+                    xattrs=True,
+                    fix_resolv_conf=False,
+                    digest=content_hash)
+                reader.drain()
+                if content_hash.hexdigest() != header['content_hash']:
+                    shutil.rmtree(rootfs, ignore_errors=True)
+                    die('layer {} does not have the content its hash claims, '
+                        'export stream is corrupted'.format(chain_hash[:12]))
+                if not reserved_ids:
+                    # the layers above are likely missing too
+                    reserved_ids = allocate_ids(count - index)
+                container = add_layer(parent, rootfs, reserved_ids.pop(0))
+                details['container'] = container
+            nodepath = nodepath_or_die(container)
+            save_hashes(nodepath, {
+                'content': header['content_hash'],
+                'chain': chain_hash,
+                'parent': parent_chain_hash
+            })
+            if header['script'] is not None:
+                save_layer_script(nodepath, header['script'])
+            plash_map(get_layer_key(chain_hash), container)
+            print('plash: layer {} imported as {}{}'.format(
+                chain_hash[:12], container,
+                ': ' + ', '.join(map(str, stages))
+                if os.environ.get('PLASH_IMPORT_STATS') else ''),
+                  file=sys.stderr)
+
+        # the build cache keys contain the ids of this host
+        if header['script'] is not None:
+            cache_key = get_cache_key(parent, header['script'])
+            if not plash_map(cache_key):
+                plash_map(cache_key, container)
+        for key in header['maps']:
+            mapped = plash_map(key)
+            if not mapped:
+                plash_map(key, container)
+            elif mapped != container:
+                print('plash: not mapping {} to {}, it maps to {} here'.format(
+                    key, container, mapped), file=sys.stderr)
+        parent_chain_hash = chain_hash
+    return container
@@ -0,0 +1,377 @@
+'''
+Download cache for `plash import-url` and the from-url and from-github macros.
+Downloads are stored once by the sha256 of their content in
+$PLASH_DATA/cache/download/blobs, urls refer to them by a record with their
+ETag and Last-Modified header. A cached url is only fetched again if the server
+says it changed, in offline mode (PLASH_OFFLINE) not at all. Interrupted
+downloads are resumed with range requests if the server supports them, large
+files are fetched with multiple connections in parallel. The modification time
+of a blob is when it was last fetched, `plash gc` deletes the least recently
+fetched ones like unused containers.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+from os.path import join
+
+from plash.utils import get_plash_data, hashstr, lock
+
+CHUNK_SIZE = 1024 * 1024
+
+# files of at least this size are split in ranges fetched in parallel
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+DEFAULT_CONNECTIONS = 4
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_download_dir():
+    return join(get_plash_data(), 'cache', 'download')
+
+
+def get_record_file(url):
+    return join(get_download_dir(), 'urls', hashstr(url.encode()) + '.json')
+
+
+def get_partial_dir(url):
+    return join(get_download_dir(), 'partial', hashstr(url.encode()))
+
+
+def get_blob(sha256):
+    return join(get_download_dir(), 'blobs', sha256)
+
+
+def get_connections():
+    return max(
+        int(os.environ.get('PLASH_DOWNLOAD_CONNECTIONS',
+                           DEFAULT_CONNECTIONS)), 1)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
+
+
+def get_validators(response):
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+
+def open_url(url, headers):
+    '''
+    Request a url, returns None if the server answers "not modified" to a
+    conditional request
+    '''
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    request = Request(url)
+    for key, value in headers.items():
+        request.add_header(key, value)
+    try:
+        return urlopen(request)
+    except HTTPError as exc:
+        if exc.code == 304:
+            return None
+        raise
+
+
+class Progress:
+    'sums the fetched bytes of all connections for a progress callback'
+
+    def __init__(self, callback, total_size, done):
+        import threading
+        self.callback = callback
+        self.total_size = total_size
+        self.done = done
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.done += size
+            if self.callback and self.total_size:
+                self.callback(self.done, self.total_size)
+
+
+class PartReader:
+    'reads the response for a part of a download and appends it to its file'
+
+    def __init__(self, response, out, progress, size):
+        self.response = response
+        self.out = out
+        self.progress = progress
+        self.left = size
+
+    def read(self, size=-1):
+        if self.left is not None:
+            size = self.left if size < 0 else min(size, self.left)
+        chunk = self.response.read(size)
+        self.out.write(chunk)
+        self.progress.add(len(chunk))
+        if self.left is not None:
+            self.left -= len(chunk)
+        return chunk
+
+
+def fetch_part(url, state, part, response, progress, stream=None):
+    '''
+    Append the missing bytes of a part of a download to its file. `response`
+    is an already opened response starting at the missing bytes, or None.
+    `stream` is called with a file object reading the part while it is
+    downloaded. Returns False if the content changed on the server.
+    '''
+    start, end = state['parts'][part]
+    part_file = join(get_partial_dir(url), str(part))
+    have = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    if end is not None and start + have >= end:
+        return True
+
+    if response is None:
+        headers = {
+            'Range':
+            'bytes={}-{}'.format(start + have, '' if end is None else end - 1)
+        }
+        if_range = state['etag'] or state['last_modified']
+        if if_range:
+            headers['If-Range'] = if_range
+        response = open_url(url, headers)
+        if response.status != 206:
+            response.close()
+            return False
+
+    with response, open(part_file, 'ab') as f:
+        reader = PartReader(response, f, progress,
+                            None if end is None else end - start - have)
+        if stream:
+            stream(reader)
+        # what the stream did not read
+        for _ in iter(lambda: reader.read(CHUNK_SIZE), b''):
+            pass
+    if end is not None and os.path.getsize(part_file) != end - start:
+        raise DownloadError('{}: connection closed before all data was '
+                            'received'.format(url))
+    return True
+
+
+def plan_parts(size, connections):
+    if not size or connections < 2 or size < PARALLEL_MIN_SIZE:
+        return [[0, size]]
+    part_size = -(-size // connections)
+    return [[start, min(start + part_size, size)]
+            for start in range(0, size, part_size)]
+
+
+def download(url, response, progress_callback, stream=None):
+    '''
+    Download a url into its partial dir, resuming what an interrupted
+    download left there. `response` is an already opened response to a
+    request without a range, or None. If the download is neither resumed nor
+    split in parts, `stream` is called with a file object reading it while it
+    is downloaded. Returns the state of the download.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    partial_dir = get_partial_dir(url)
+    state_file = join(partial_dir, 'state.json')
+    state = None if response else read_json(state_file)
+    if state is None:
+        if response is None:
+            response = open_url(url, {})
+        size = int(response.headers.get('Content-Length') or 0) or None
+        ranges = response.headers.get('Accept-Ranges') == 'bytes'
+        state = dict(get_validators(response), url=url, size=size)
+        state['parts'] = plan_parts(size, get_connections() if ranges else 1)
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir)
+        write_json(state_file, state)
+    else:
+        print('plash: resuming download', file=sys.stderr)
+
+    done = sum(
+        os.path.getsize(join(partial_dir, str(part)))
+        for part in range(len(state['parts']))
+        if os.path.exists(join(partial_dir, str(part))))
+    progress = Progress(progress_callback, state['size'], done)
+    # the first part is read from the response we already have
+    responses = {0: response} if response else {}
+    if response and stream and len(state['parts']) == 1:
+        fetch_part(url, state, 0, response, progress, stream)
+        return state
+    with ThreadPoolExecutor(len(state['parts'])) as executor:
+        unchanged = list(
+            executor.map(
+                lambda part: fetch_part(url, state, part,
+                                        responses.get(part), progress),
+                range(len(state['parts']))))
+    if not all(unchanged):
+        print('plash: restarting download, it changed', file=sys.stderr)
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        return download(url, None, progress_callback, stream)
+    return state
+
+
+def store(url, state):
+    '''
+    Join the parts of a finished download into a blob named by its hash and
+    record it for its url. A blob with the same content is reused.
+    '''
+    partial_dir = get_partial_dir(url)
+    part_files = [
+        join(partial_dir, str(part)) for part in range(len(state['parts']))
+    ]
+    sha256 = hashlib.sha256()
+    if len(part_files) == 1:
+        joined_file = part_files[0]
+        with open(joined_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+    else:
+        joined_file = join(partial_dir, 'joined')
+        with open(joined_file, 'wb') as out:
+            for part_file in part_files:
+                with open(part_file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        sha256.update(chunk)
+                        out.write(chunk)
+    digest = sha256.hexdigest()
+    blob = get_blob(digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    if os.path.exists(blob):
+        os.utime(blob)
+    else:
+        os.rename(joined_file, blob)
+
+    record_file = get_record_file(url)
+    old_record = read_json(record_file)
+    write_json(
+        record_file, {
+            'url': url,
+            'sha256': digest,
+            'etag': state['etag'],
+            'last_modified': state['last_modified'],
+        })
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    if old_record and old_record['sha256'] != digest:
+        remove_unused_blob(old_record['sha256'])
+    return blob
+
+
+def remove_unused_blob(sha256):
+    'delete a blob if no url refers to it anymore'
+    urls_dir = join(get_download_dir(), 'urls')
+    for record_file in os.listdir(urls_dir):
+        record = read_json(join(urls_dir, record_file))
+        if record and record['sha256'] == sha256:
+            return
+    try:
+        os.unlink(get_blob(sha256))
+    except FileNotFoundError:
+        pass
+
+
+def get_blobs():
+    '''
+    Return a dict of the cached downloads by their sha256 with their size, last
+    fetch time and the urls referring to them
+    '''
+    blobs_dir = join(get_download_dir(), 'blobs')
+    urls_dir = join(get_download_dir(), 'urls')
+    blobs = {}
+    try:
+        files = os.listdir(blobs_dir)
+    except FileNotFoundError:
+        return blobs
+    for sha256 in files:
+        try:
+            stat = os.stat(join(blobs_dir, sha256))
+        except FileNotFoundError:
+            continue  # race condition, removed by another process
+        blobs[sha256] = (stat.st_size, stat.st_mtime, [])
+    try:
+        record_files = os.listdir(urls_dir)
+    except FileNotFoundError:
+        record_files = []
+    for record_file in record_files:
+        record = read_json(join(urls_dir, record_file))
+        if record and record['sha256'] in blobs:
+            blobs[record['sha256']][2].append(record['url'])
+    return blobs
+
+
+def remove_blobs(blobs):
+    '''
+    Delete cached downloads and forget the urls referring to them, they are
+    downloaded again when fetched next time
+    '''
+    from contextlib import ExitStack
+    cached = get_blobs()
+    for sha256 in blobs:
+        _, _, urls = cached.get(sha256, (None, None, []))
+        with ExitStack() as stack:
+            # don't remove a blob a fetch of its urls is about to return
+            for url in sorted(urls):
+                stack.enter_context(lock('download-' + hashstr(url.encode())))
+            for url in urls:
+                record = read_json(get_record_file(url))
+                if record and record['sha256'] == sha256:
+                    os.unlink(get_record_file(url))
+            try:
+                os.unlink(get_blob(sha256))
+            except FileNotFoundError:
+                pass
+
+
+def fetch(url, progress=None, stream=None):
+    '''
+    Return the path of a file with the content of url, downloading it if it is
+    not cached or changed. `progress` is called with the fetched and the total
+    bytes while downloading. If the url is downloaded with one connection from
+    its start, `stream` is called with a file object reading the download
+    while it is downloaded, check if it was called to know if the content was
+    streamed. Raises the errors of urllib, OSError and DownloadError.
+    '''
+    with lock('download-' + hashstr(url.encode())):
+        record = read_json(get_record_file(url))
+        blob = record and get_blob(record['sha256'])
+        if blob and not os.path.exists(blob):
+            blob = None
+
+        if blob and os.environ.get('PLASH_OFFLINE'):
+            os.utime(blob)
+            return blob
+
+        response = None
+        resuming = os.path.exists(join(get_partial_dir(url), 'state.json'))
+        if blob and not resuming:
+            headers = {}
+            if record['etag']:
+                headers['If-None-Match'] = record['etag']
+            if record['last_modified']:
+                headers['If-Modified-Since'] = record['last_modified']
+            # without validators it is fetched again, unchanged content is
+            # still stored only once
+            response = open_url(url, headers)
+            if response is None:
+                os.utime(blob)
+                return blob
+        elif not blob and os.environ.get('PLASH_OFFLINE'):
+            raise DownloadError('{}: offline and not cached'.format(url))
+
+        state = download(url, response, progress, stream)
+        return store(url, state)
@@ -3,11 +3,48 @@ import os
 import re
 import shlex
 import sys
+from contextlib import contextmanager
 from functools import wraps
 
 FIND_HIND_HINT_VALUES_RE = re.compile('### plash hint: ([^=\n]+)=([^\n]+)\n')
 
-state = {'macros': {}}
+
+class Macros(dict):
+    '''
+    The macros by name. Builtin macros are looked up in plash.macros.index
+    and their module is imported when one of them is used first. Macros
+    registered before keep their name.
+    '''
+
+    def __missing__(self, name):
+        from plash.macros.index import MACROS
+        try:
+            module, _ = MACROS[name]
+        except KeyError:
+            raise KeyError(name)
+        registered = dict(self)
+        importlib.import_module(module)
+        self.update(state['registered'].get(module, {}))
+        self.update(registered)
+        if not dict.__contains__(self, name):
+            raise KeyError(name)
+        return dict.__getitem__(self, name)
+
+
+state = {
+    'macros': Macros(),
+    # macros the evaluated lines defined, they shadow the others and are gone
+    # when the evaluation is done
+    'user_macros': {},
+    # the macros each module registered, by module name
+    'registered': {},
+    # lists collecting the inputs of running evaluations
+    'recorders': [],
+    # the files being evaluated by eval-file, the outermost first
+    'evaluating': [],
+    # evaluated files by path, mtime and size with their results and inputs
+    'evaluated_files': {},
+}
 
 
 class MacroNotFoundError(Exception):
@@ -32,15 +69,32 @@ def get_macros():
     return state['macros']
 
 
+def get_registered_macros():
+    'import all builtin macros and return their module and documentation'
+    import plash.macros.all
+    return {
+        name: (module, func.__doc__)
+        for module, registered in state['registered'].items()
+        if module.startswith('plash.macros.')
+        for name, func in registered.items()
+    }
+
+
 def register_macro(name=None, group='main'):
     def decorator(func):
         macro = name or func.__name__.replace('_', '-')
         state['macros'][macro] = func
+        state['registered'].setdefault(func.__module__, {})[macro] = func
         return func
 
     return decorator
 
 
+def define_macro(name, func):
+    'define a macro for the rest of the running evaluation'
+    state['user_macros'][name] = func
+
+
 def shell_escape_args(func):
     @wraps(func)
     def function_wrapper(*args):
@@ -76,7 +130,7 @@ def eval(lisp):
         name = item[0]
         args = item[1:]
         try:
-            macro = state['macros'][name]
+            macro = state['user_macros'].get(name) or state['macros'][name]
         except KeyError:
             raise MacroNotFoundError("macro {} not found".format(repr(name)))
         try:
@@ -97,6 +151,164 @@ def eval(lisp):
     return '\n'.join(macro_values)
 
 
+def parse(lines):
+    '''
+    parse plash command line like lines to plash lisp
+    '''
+    tokens = []
+    tokens_escape_status = []
+    for line in lines:
+        if line.startswith('--#'):
+            continue
+        elif line == '--\\':
+            tokens.append('')
+            tokens_escape_status.append(True)
+        elif line.startswith('--\\ '):
+            tokens.append(line[4:])
+            tokens_escape_status.append(True)
+        elif line.startswith('-'):
+            fst, *rest = line.split()
+            tokens.append(fst)
+            tokens_escape_status.append(False)
+            tokens.extend(rest)
+            tokens_escape_status.extend(True for i in rest)
+        else:
+            tokens.append(line)
+            tokens_escape_status.append(False)
+    assert len(tokens) == len(tokens_escape_status)
+
+    lsp = []
+    for token, token_is_escaped in zip(tokens, tokens_escape_status):
+
+        if token_is_escaped:
+            try:
+                lsp[-1].append(token)
+            except IndexError:
+                raise EvalError(
+                    'parse: first token can not be escaped (got {})'.format(
+                        repr(token)))
+        elif token.startswith('--'):
+            lsp.append([token[2:]])
+        elif token.startswith('-') and not token == '-':
+            for single_letter_opt in token[1:]:
+                lsp.append([single_letter_opt])
+        elif token:
+            try:
+                lsp[-1].append(token)
+            except IndexError:
+                raise EvalError(
+                    'parse: first token must be an action prefixed by two dashes (got {})'
+                    .format(repr(token)))
+    return lsp
+
+
+def eval_lines(lines):
+    '''
+    parse and evaluate lines with all builtin macros, returns the build script
+    '''
+    lines = list(lines)
+
+    # a little magic: remove possible shebang
+    if lines and lines[0].startswith('#!/'):
+        lines.pop(0)
+
+    user_macros = state['user_macros']
+    state['user_macros'] = {}
+    try:
+        script = eval(parse(lines))
+    finally:
+        state['user_macros'] = user_macros
+    if script and not script.endswith('\n'):
+        script += '\n'  # that '\n' is right
+    return script
+
+
+def get_builtin_macros():
+    'the macros of a new process, the others are imported when used'
+    return Macros(state['registered'][__name__])
+
+
+def eval_nested(lines):
+    '''
+    Evaluate lines inside a macro, as a new `plash eval` process would: only
+    the builtin macros are there and macros imported by the lines are gone
+    afterwards.
+    '''
+    macros = state['macros']
+    state['macros'] = get_builtin_macros()
+    try:
+        return eval_lines(lines)
+    finally:
+        state['macros'] = macros
+
+
+def eval_path(fname):
+    '''
+    Evaluate the lines of a file with eval_nested. Files are evaluated once
+    per process while their mtime and size stay the same, the inputs of the
+    first evaluation are recorded again for later ones. Raises EvalError if
+    the file is already being evaluated, when files include each other.
+    '''
+    from plash.utils import hashstr
+    if fname in state['evaluating']:
+        raise EvalError('eval-file: include cycle: {}'.format(' -> '.join(
+            state['evaluating'][state['evaluating'].index(fname):] +
+            [fname])))
+    stat = os.stat(fname)
+    memo_key = (fname, stat.st_mtime_ns, stat.st_size)
+    try:
+        script, inputs = state['evaluated_files'][memo_key]
+    except KeyError:
+        pass
+    else:
+        for input in inputs:
+            record_input(*input)
+        return script
+
+    with open(fname) as f:
+        inscript = f.read()
+    lines = inscript.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    inputs = []
+    state['recorders'].append(inputs)
+    state['evaluating'].append(fname)
+    try:
+        record_input('file', fname, hashstr(inscript.encode()))
+        script = eval_nested(lines)
+    finally:
+        state['evaluating'].pop()
+        state['recorders'].remove(inputs)
+    if ['volatile'] not in inputs:
+        state['evaluated_files'][memo_key] = (script, inputs)
+    return script
+
+
+def record_input(kind, *args):
+    '''
+    Note something besides the evaluated lines the result depends on, cached
+    builds check these to see if they are still valid. The kind 'volatile'
+    means that the result must not be cached.
+    '''
+    for recorder in state['recorders']:
+        recorder.append([kind] + list(args))
+
+
+@contextmanager
+def recording_inputs():
+    '''
+    Yield a list that gets the inputs recorded in the with block. Recording
+    starts a new frame, evaluations around it don't get these inputs.
+    '''
+    inputs = []
+    recorders = state['recorders']
+    state['recorders'] = [inputs]
+    try:
+        yield inputs
+    finally:
+        state['recorders'] = recorders
+
+
 def remove_hint_values(script):
     return FIND_HIND_HINT_VALUES_RE.sub('', script)
 
@@ -108,9 +320,12 @@ def get_hint_values(script):
 @register_macro('import')
 def import_(*modules):
     'import macros from any python module'
+    record_input('volatile')  # we don't know what these macros do
     output = []
     for module_name in modules:
         importlib.import_module(module_name)
+        # modules imported before don't register their macros again
+        state['macros'].update(state['registered'].get(module_name, {}))
 
 
 @register_macro()
@@ -0,0 +1,322 @@
+'''
+Streaming tar extraction. Reading, decompressing and extracting run at the same
+time connected by pipes, so an import takes about as long as its slowest stage.
+'''
+
+import bz2
+import itertools
+import lzma
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+from plash.utils import die
+
+CHUNK_SIZE = 1024 * 1024
+
+# name, magic bytes, external decompressors by preference, python fallback
+COMPRESSIONS = [
+    ('xz', b'\xfd7zXZ\x00', [['xz', '-d', '-T0']], lzma.LZMADecompressor),
+    ('zstd', b'\x28\xb5\x2f\xfd', [['zstd', '-d', '-q']], None),
+    ('gzip', b'\x1f\x8b', [['pigz', '-d'], ['gzip', '-d']],
+     lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    ('bzip2', b'BZh', [['lbzip2', '-d'], ['bzip2', '-d']],
+     bz2.BZ2Decompressor),
+]
+
+TAR_MKNOD_ERROR = re.compile(rb'^tar: (.*): Cannot mknod: (.*)$')
+TAR_EXIT_ERROR = b'tar: Exiting with failure status due to previous errors'
+
+
+class PlashTarFile(tarfile.TarFile):
+    def makedev(self, tarinfo, targetpath):
+        try:
+            tarfile.TarFile.makedev(self, tarinfo, targetpath)
+        except OSError as exc:
+            print(
+                'plash: ignoring dev file: {} ({})'.format(
+                    tarinfo.path, exc.strerror),
+                file=sys.stderr)
+
+
+class Stage:
+    'counts the bytes passing through a stage of the import'
+
+    def __init__(self, name, tool=None):
+        self.name = name
+        self.tool = tool
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+
+    def add(self, size):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.bytes += size
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def __str__(self):
+        seconds = (self.finished or time.monotonic()) - (self.started
+                                                         or time.monotonic())
+        megabytes = self.bytes / 1000 / 1000
+        return '{}{} {:.1f} MB at {:.1f} MB/s'.format(
+            self.name, ' ({})'.format(self.tool) if self.tool else '',
+            megabytes, megabytes / seconds if seconds > 0 else 0)
+
+
+class CountingReader:
+    def __init__(self, fileobj, stage):
+        self.fileobj = fileobj
+        self.stage = stage
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.stage.add(len(data))
+        return data
+
+
+def print_stages(stages):
+    'print the stats of each stage of an import if PLASH_IMPORT_STATS is set'
+    if os.environ.get('PLASH_IMPORT_STATS'):
+        for stage in stages:
+            print('plash: {}'.format(stage), file=sys.stderr)
+
+
+def read_chunks(fileobj):
+    return iter(lambda: fileobj.read(CHUNK_SIZE), b'')
+
+
+def pump(chunks, dst, stage, tee=None, progress=None, digest=None):
+    'write chunks to dst and close it, also when failing'
+    try:
+        for chunk in chunks:
+            if tee:
+                tee.write(chunk)
+            if digest:
+                digest.update(chunk)
+            stage.add(len(chunk))
+            dst.write(chunk)
+            if progress:
+                progress(stage.bytes)
+    finally:
+        stage.finish()
+        dst.close()
+
+
+def decompress_chunks(decompressor, chunks):
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    flush = getattr(decompressor, 'flush', None)
+    if flush:
+        yield flush()
+
+
+def find_gnu_tar():
+    'GNU tar extracts much faster than the tarfile module'
+    tar = shutil.which('tar')
+    if not tar:
+        return None
+    try:
+        version = subprocess.run([tar, '--version'],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return None
+    return 'tar' if b'GNU tar' in version else None
+
+
+def find_decompressor(head):
+    for name, magic, cmds, fallback in COMPRESSIONS:
+        if head.startswith(magic):
+            for cmd in cmds:
+                if shutil.which(cmd[0]):
+                    return name, cmd, None
+            if not fallback:
+                die('{} seems not to be installed'.format(name))
+            return name, None, fallback()
+    return None, None, None
+
+
+def check_tar_stderr(returncode, stderr):
+    'print warnings of GNU tar and die on errors other than device files'
+    unexpected = []
+    for line in stderr.splitlines():
+        match = TAR_MKNOD_ERROR.match(line)
+        if match:
+            print(
+                'plash: ignoring dev file: {} ({})'.format(
+                    match.group(1).decode(errors='replace'),
+                    match.group(2).decode(errors='replace')),
+                file=sys.stderr)
+        elif line != TAR_EXIT_ERROR:
+            unexpected.append(line)
+    for line in unexpected:
+        sys.stderr.buffer.write(line + b'\n')
+    sys.stderr.flush()
+    if returncode and (unexpected or returncode != 2):
+        die('extracting tar failed with exit status {}'.format(returncode))
+
+
+def extract_tar(src,
+                rootfs,
+                source='read',
+                tee=None,
+                progress=None,
+                xattrs=False,
+                fix_resolv_conf=True,
+                digest=None):
+    '''
+    Extract a tar stream, compressed or not, into rootfs. Decompression uses
+    an external program if installed and runs in its own process or thread.
+    `tee` gets a copy of the raw stream, `progress` is called with the count of
+    read bytes. Extended attributes are only extracted with `xattrs` and GNU
+    tar. Unless `fix_resolv_conf` is false, etc/resolv.conf is made an empty
+    file. `digest` is a hashlib object updated with the uncompressed tar
+    stream. Returns the stats of each stage.
+    '''
+    head = src.read(CHUNK_SIZE)
+    name, cmd, decompressor = find_decompressor(head)
+    tar = find_gnu_tar()
+    read_stage = Stage(source)
+    decompress_stage = Stage('decompressed', tool=cmd[0] if cmd else 'python')
+    extract_stage = Stage('extracted', tool='tar' if tar else 'python')
+    stages = [read_stage, decompress_stage, extract_stage] if name else [
+        read_stage, extract_stage
+    ]
+
+    threads = []
+    errors = []
+
+    def spawn(func, *args, **kwargs):
+        def run():
+            try:
+                func(*args, **kwargs)
+            except Exception as exc:
+                errors.append(exc)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    # the extracting stage
+    if tar:
+        tar_stderr = tempfile.TemporaryFile()
+        extractor = subprocess.Popen(
+            [tar, '-x', '-p', '--numeric-owner', '-f', '-', '-C', rootfs] +
+            (['--xattrs', '--xattrs-include=*'] if xattrs else []),
+            stdin=subprocess.PIPE,
+            stderr=tar_stderr)
+        extract_input = extractor.stdin
+    else:
+        read_fd, write_fd = os.pipe()
+        extract_input = open(write_fd, 'wb')
+
+    # the reading and decompressing stages
+    chunks = itertools.chain([head], read_chunks(src))
+    decompress_process = None
+    if cmd:
+        decompress_process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        spawn(
+            pump,
+            chunks,
+            decompress_process.stdin,
+            read_stage,
+            tee=tee,
+            progress=progress)
+        spawn(
+            pump,
+            read_chunks(decompress_process.stdout),
+            extract_input,
+            decompress_stage,
+            digest=digest)
+    elif decompressor:
+        decompress_read_fd, decompress_write_fd = os.pipe()
+        spawn(
+            pump,
+            chunks,
+            open(decompress_write_fd, 'wb'),
+            read_stage,
+            tee=tee,
+            progress=progress)
+        spawn(
+            pump,
+            decompress_chunks(decompressor,
+                              read_chunks(open(decompress_read_fd, 'rb'))),
+            extract_input,
+            decompress_stage,
+            digest=digest)
+    else:
+        spawn(
+            pump,
+            chunks,
+            extract_input,
+            read_stage,
+            tee=tee,
+            progress=progress,
+            digest=digest)
+
+    extract_error = None
+    if tar:
+        extractor.wait()
+        # tar reads what the last stage before it wrote
+        fed_stage = decompress_stage if name else read_stage
+        extract_stage.bytes = fed_stage.bytes
+        extract_stage.started = fed_stage.started
+    else:
+        try:
+            with open(read_fd, 'rb') as f:
+                t = PlashTarFile.open(
+                    fileobj=CountingReader(f, extract_stage), mode='r|')
+                t.extractall(rootfs, numeric_owner=True)
+                # read the padding at the end so the other stages can finish
+                for _ in read_chunks(f):
+                    pass
+        except Exception as exc:
+            extract_error = exc
+    extract_stage.finish()
+    for thread in threads:
+        thread.join()
+    if decompress_process:
+        decompress_process.wait()
+
+    # report the error closest to the source, a broken pipe just means that a
+    # later stage failed
+    for error in errors:
+        if not isinstance(error, BrokenPipeError):
+            raise error
+    if decompress_process and decompress_process.returncode:
+        die('decompressing with {} failed with exit status {}'.format(
+            cmd[0], decompress_process.returncode))
+    if tar:
+        tar_stderr.seek(0)
+        check_tar_stderr(extractor.returncode, tar_stderr.read())
+    if extract_error:
+        raise extract_error
+    if errors:
+        raise errors[0]
+    if not fix_resolv_conf:
+        return stages
+
+    # we want /etc/resolv to not be a symlink or to exist as a file - otherwise
+    # moutning over it later does not work
+    os.makedirs(os.path.join(rootfs, 'etc'), exist_ok=True)
+    resolvconf = os.path.join(rootfs, 'etc/resolv.conf')
+    try:
+        os.unlink(resolvconf)
+    except FileNotFoundError:
+        pass
+    with open(resolvconf, 'w') as f:
+        f.seek(0)
+        f.truncate()
+
+    return stages
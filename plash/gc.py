@@ -0,0 +1,270 @@
+'''
+Find the containers to delete to keep the build data under a size or to
+delete containers not used for some time. Containers are deleted leaf first,
+the least recently used first. Of the containers last used on the same day, the
+ones freeing the most bytes per second it takes to build them again go first.
+Cached downloads are deleted the same way, as leaves never built.
+'''
+
+import heapq
+import os
+import re
+from collections import defaultdict
+from os.path import basename, join
+
+from plash import download, metadata, trash
+from plash.layout import get_parent
+from plash.utils import die, get_plash_data
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24,
+             'w': 60 * 60 * 24 * 7}
+
+# build cache keys are sha1 hexdigests and the keys of exported or imported
+# layers their chain hash (see plash.delta), other map keys are set by the user
+BUILD_CACHE_KEY = re.compile('[0-9a-f]{40}|layer-[0-9a-f]{64}')
+
+# containers last used within the same period count as used at the same time
+LRU_PERIOD = 60 * 60 * 24
+
+# the rebuild cost assumed for layers not built by `plash build`, like
+# imported ones, and the least for the others
+MIN_REBUILD_SECONDS = 1
+
+
+def parse_size(size):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMGT]?)B?', size.upper())
+    if not match:
+        die('invalid size: {} (try something like 50G)'.format(repr(size)))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_age(age):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', age)
+    if not match:
+        die('invalid age: {} (try something like 30d)'.format(repr(age)))
+    return float(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+def format_size(size):
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'T'
+    return '{:.1f}{}'.format(size, unit) if unit else '{}'.format(size)
+
+
+def get_nodepaths():
+    'return a dict of all existing containers and their nodepaths'
+    if metadata.is_enabled():
+        return metadata.get_containers()
+    index_dir = join(get_plash_data(), 'index')
+    nodepaths = {}
+    for container in os.listdir(index_dir):
+        try:
+            nodepath = os.readlink(join(index_dir, container))
+            os.stat(nodepath)
+        except OSError:
+            continue  # broken link, it's `plash clean`s responsability
+        if container != '0':
+            nodepaths[container] = nodepath
+    return nodepaths
+
+
+def get_parents(nodepaths):
+    'return a dict of the containers and the ids of their parents'
+    if metadata.is_enabled():
+        parents = metadata.get_parents()
+        return {c: parents[c] for c in nodepaths if c in parents}
+    return {c: get_parent(n) for c, n in nodepaths.items()}
+
+
+def get_stacked(nodepaths):
+    '''
+    Add the containers stacked on the containers in `nodepaths`, directly or
+    not, to it and return it with a dict of their parents. Only without the
+    metadata index all containers are read to find them.
+    '''
+    nodepaths = dict(nodepaths)
+    parents = {c: get_parent(n) for c, n in nodepaths.items()}
+    if metadata.is_enabled():
+        for container, (nodepath, parent) in metadata.get_descendants(
+                nodepaths).items():
+            nodepaths[container] = nodepath
+            parents[container] = parent
+        return nodepaths, parents
+    all_nodepaths = get_nodepaths()
+    all_nodepaths.update(nodepaths)
+    return all_nodepaths, get_parents(all_nodepaths)
+
+
+def get_depths(parents, containers):
+    'return how many layers each of the containers is stacked on'
+    depths = {'0': 0}
+
+    def depth(container):
+        chain = []
+        while container not in depths:
+            chain.append(container)
+            container = parents.get(container, '0')
+        for child in reversed(chain):
+            depths[child] = depths[container] + 1
+            container = child
+        return depths[container]
+
+    return {c: depth(c) for c in containers}
+
+
+def with_descendants(containers, parents):
+    '''
+    Return the containers and all containers stacked on them, children before
+    their parents. `parents` is what `get_parents` returns.
+    '''
+    children = defaultdict(set)
+    for container, parent in parents.items():
+        children[parent].add(container)
+    found = set()
+    pending = list(containers)
+    while pending:
+        container = pending.pop()
+        if container not in found:
+            found.add(container)
+            pending.extend(children[container])
+    depths = get_depths(parents, found)
+    return sorted(found, key=lambda c: -depths[c])
+
+
+def get_mapped():
+    'return the containers referenced by map keys that are not build cache'
+    if metadata.is_enabled():
+        maps = metadata.get_maps()
+    else:
+        map_dir = join(get_plash_data(), 'map')
+        maps = {}
+        for key in os.listdir(map_dir):
+            try:
+                maps[key] = basename(os.readlink(join(map_dir, key)))
+            except OSError:
+                continue
+    return {
+        container
+        for key, container in maps.items()
+        if not BUILD_CACHE_KEY.fullmatch(key)
+    }
+
+
+def get_value(size, build_seconds):
+    'the bytes a container frees per second it takes to build it again'
+    return size / max(build_seconds or 0, MIN_REBUILD_SECONDS)
+
+
+def plan(keep_under=None, older_than=None, now=None):
+    '''
+    Return the containers to delete with their size, last use time and build
+    seconds (None if not known), in the order they must be deleted, the cached
+    downloads to delete with their size, last fetch time and urls, and the
+    size of all containers and downloads.
+    '''
+    from plash.mount import get_mounts
+    nodepaths = get_nodepaths()
+    parents = get_parents(nodepaths)
+    children = defaultdict(set)
+    for container, parent in parents.items():
+        children[parent].add(container)
+
+    infos = metadata.get_layer_infos() if metadata.is_enabled() else {}
+    sizes = {}
+    last_used = {}
+    build_seconds = {}
+    for container, nodepath in nodepaths.items():
+        size, indexed_last_used, indexed_build_seconds = infos.get(
+            container, (None, None, None))
+        sizes[container] = size if size is not None else (
+            metadata.get_layer_size(nodepath))
+        build_seconds[container] = (
+            indexed_build_seconds if container in infos else
+            metadata.get_build_seconds(nodepath))
+        try:
+            mtime = os.stat(join(nodepath, '_data')).st_mtime
+        except FileNotFoundError:
+            mtime = 0
+        last_used[container] = max(mtime, indexed_last_used or 0)
+
+    # using a container uses all its parents
+    depths = get_depths(parents, nodepaths)
+    for container in sorted(nodepaths, key=lambda c: -depths[c]):
+        parent = parents[container]
+        if parent in last_used:
+            last_used[parent] = max(last_used[parent], last_used[container])
+
+    # don't delete used and mapped containers and what they are built on
+    protected = set()
+    used = {container for container, in_use, _ in get_mounts() if in_use}
+    for container in used | get_mapped():
+        while container in nodepaths and container not in protected:
+            protected.add(container)
+            container = parents[container]
+
+    # downloads are keyed by their sha256, containers by their number
+    blobs = download.get_blobs()
+    for sha256, (size, fetched, _) in blobs.items():
+        sizes[sha256] = size
+        last_used[sha256] = fetched
+        build_seconds[sha256] = None
+
+    def candidate(container):
+        return (last_used[container] // LRU_PERIOD,
+                -get_value(sizes[container], build_seconds[container]),
+                container)
+
+    total = sum(sizes.values())
+    cutoff = (now - older_than) if older_than is not None else None
+    leaves = [
+        candidate(c) for c in nodepaths
+        if not children[c] and c not in protected
+    ] + [candidate(sha256) for sha256 in blobs]
+    heapq.heapify(leaves)
+    planned = []
+    planned_downloads = []
+    remaining = total
+    while leaves:
+        _, _, container = heapq.heappop(leaves)
+        over_budget = keep_under is not None and remaining > keep_under
+        too_old = cutoff is not None and last_used[container] < cutoff
+        if not over_budget and not too_old:
+            # keep it and what it is built on, an older one of the same
+            # period may come later
+            continue
+        remaining -= sizes[container]
+        if container in blobs:
+            planned_downloads.append((container, sizes[container],
+                                      last_used[container],
+                                      blobs[container][2]))
+            continue
+        planned.append((container, sizes[container], last_used[container],
+                        build_seconds[container]))
+        parent = parents[container]
+        children[parent].discard(container)
+        if parent in nodepaths and not children[parent] and (
+                parent not in protected):
+            heapq.heappush(leaves, candidate(parent))
+    return planned, planned_downloads, total
+
+
+def remove(containers, nodepaths=None):
+    '''
+    Delete containers, children must come before their parents. Their files
+    are deleted in the background.
+    '''
+    if nodepaths is None:
+        nodepaths = get_nodepaths()
+    for container in containers:
+        try:
+            nodepath = nodepaths[container]
+        except KeyError:
+            continue  # another process already deleted it
+        if trash.move_to_trash(nodepath):
+            metadata.remove_container(nodepath)
+    trash.empty_in_background()
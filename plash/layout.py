@@ -0,0 +1,142 @@
+'''
+How layers are stored. Every layer is the directory $PLASH_DATA/layer/ID with
+its files in _data/root and the id of the container it is stacked on in
+_data/parent. Older versions nested each layer in the directory of its parent
+(layer/0/2/19), such layers are still understood and `plash migrate` moves
+them to the flat layout. Container ids are handed out by a counter in
+$PLASH_DATA/id_counter.
+'''
+
+import os
+from os.path import basename, dirname, join
+
+from plash.utils import get_plash_data
+
+PARENT_FILE = 'parent'
+
+
+def get_layer_dir(container):
+    return join(get_plash_data(), 'layer', container)
+
+
+def is_nested(nodepath):
+    'if a layer is stored in the nested layout of older versions'
+    return basename(dirname(nodepath)) != 'layer'
+
+
+def get_parent(nodepath):
+    'the id of the container a layer is stacked on'
+    try:
+        with open(join(nodepath, '_data', PARENT_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return basename(dirname(nodepath))
+
+
+def save_parent(nodepath, parent):
+    parent_file = join(nodepath, '_data', PARENT_FILE)
+    with open(parent_file + '.tmp', 'w') as f:
+        f.write(parent + '\n')
+    os.rename(parent_file + '.tmp', parent_file)
+
+
+def get_ancestors(nodepath):
+    '''
+    Return the nodepaths of a container and the containers it is stacked on,
+    the container first and the root container excluded. Raises OSError if
+    one is missing.
+    '''
+    index_dir = join(get_plash_data(), 'index')
+    nodepaths = []
+    while basename(nodepath) != '0':
+        nodepaths.append(nodepath)
+        nodepath = os.readlink(join(index_dir, get_parent(nodepath)))
+    return nodepaths
+
+
+def read_counter(fd):
+    content = os.pread(fd, 64, 0)
+    if content.startswith(b'A'):
+        # older versions appended one byte for every id
+        return os.fstat(fd).st_size
+    return int(content.split(b'\n')[0] or 0)
+
+
+def allocate_ids(count=1):
+    '''
+    Reserve `count` consecutive container ids and return them. The counter is
+    locked while it is increased, so processes allocating at the same time
+    never get the same ids.
+    '''
+    import fcntl
+    fd = os.open(
+        join(get_plash_data(), 'id_counter'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        last = read_counter(fd)
+        counter = '{}\n'.format(last + count).encode()
+        os.pwrite(fd, counter, 0)
+        os.ftruncate(fd, len(counter))
+    finally:
+        os.close(fd)
+    return [str(i) for i in range(last + 1, last + count + 1)]
+
+
+def get_nested():
+    'return a dict of the containers in the nested layout and their nodepaths'
+    index_dir = join(get_plash_data(), 'index')
+    nested = {}
+    for container in os.listdir(index_dir):
+        try:
+            nodepath = os.readlink(join(index_dir, container))
+        except OSError:
+            continue
+        if container != '0' and is_nested(nodepath) and os.path.isdir(
+                nodepath):
+            nested[container] = nodepath
+    return nested
+
+
+def relink(link, target):
+    'atomically point a symlink to another target'
+    os.symlink(target, link + '.tmp')
+    os.rename(link + '.tmp', link)
+
+
+def migrate():
+    '''
+    Move the layers of the nested layout to the flat layout and point the
+    index and map symlinks to their new place. Running it again finishes an
+    interrupted migration. Returns how many layers were moved.
+    '''
+    plash_data = get_plash_data()
+    index_dir = join(plash_data, 'index')
+    map_dir = join(plash_data, 'map')
+    nested = get_nested()
+
+    # the deepest first, so the nodepaths of the others stay valid
+    moved = 0
+    for container, nodepath in sorted(
+            nested.items(), key=lambda i: -i[1].count('/')):
+        save_parent(nodepath, basename(dirname(nodepath)))
+        os.rename(nodepath, get_layer_dir(container))
+        relink(join(index_dir, container), get_layer_dir(container))
+        moved += 1
+
+    # also fix links of layers moved by an interrupted migration
+    for link_dir in (index_dir, map_dir):
+        for name in os.listdir(link_dir):
+            link = join(link_dir, name)
+            try:
+                nodepath = os.readlink(link)
+            except OSError:
+                continue
+            flat = get_layer_dir(basename(nodepath))
+            if nodepath != flat and not os.path.exists(
+                    nodepath) and os.path.isdir(flat):
+                relink(link, flat)
+
+    from plash import metadata
+    if metadata.is_enabled():
+        metadata.rebuild()
+    return moved
@@ -0,0 +1,187 @@
+'''
+The image catalogue of images.linuxcontainers.org. The listing is parsed once
+into a table of image names and cached in $PLASH_DATA/cache, later calls only
+revalidate it when it is older than PLASH_LXC_TTL seconds.
+'''
+
+import json
+import os
+import re
+import sys
+import time
+from os.path import join
+
+from plash.utils import die, get_plash_data, mkdtemp
+
+DEFAULT_LXC_URL = 'https://images.linuxcontainers.org/'
+DEFAULT_TTL = 3600
+IMAGE_URL_TEMPL = 'images/{}/{}/{}/{}/{}/rootfs.tar.xz'
+UBUNTU_ABC = 'pqrstuvwxyzabcdefghijklmno'  # rotate manually every 10 years or so
+
+DEBIAN_RELESES = [
+    # well, some constant in some file to keep updated... That here should only be fine until 2022 or something
+    'bullseye',
+    'buster',
+    'stretch',
+    'jessie',
+    'wheezy'
+]
+
+ROW_REGEX = re.compile(
+    '<tr><td>(.+?)</td><td>(.+?)</td><td>(.+?)</td><td>(.+?)</td><td>(.+?)</td><td>(.+?)</td><td>(.+?)</td><td>(.+?)</td></tr>'
+)
+
+
+def get_lxc_url():
+    url = os.environ.get('PLASH_LXC_URL', DEFAULT_LXC_URL)
+    return url if url.endswith('/') else url + '/'
+
+
+def parse_catalogue(content, lxc_url):
+    'return a dict of image names and their urls from the html image listing'
+    distros = {}
+    names = {}
+    for distro, version, arch, variant, date, _, _, _ in ROW_REGEX.findall(
+            content):
+        if not variant == 'default':
+            continue
+
+        if arch != 'amd64':  # only support this right now
+            continue
+
+        url = lxc_url + IMAGE_URL_TEMPL.format(distro, version, arch, variant,
+                                               date)
+
+        if not version == 'current':
+            names['{}:{}'.format(distro, version)] = url
+        else:
+            names[distro] = url
+
+        if version[0].isalpha() and not version == 'current':
+            # path parts with older upload_version also come later
+            # (ignore possibel alphanumeric sort for dates on this right now)
+            names[version] = url
+
+        distros.setdefault(distro, [])
+        distros[distro].append(version)
+
+    #
+    # also add entries where we call the version name e.g. "jessie"
+    #
+    for distro, versions in distros.items():
+
+        if versions == ['current']:
+            continue
+
+        if distro == 'alpine' and 'edge' in versions:
+            versions.remove('edge')
+
+        if distro == 'ubuntu':
+            newest = sorted(
+                versions, key=lambda v: UBUNTU_ABC.index(v[0]))[-1]
+        elif distro == 'debian':
+            if 'sid' in versions:
+                versions.remove('sid')
+            newest = sorted(
+                versions, key=lambda v: -1 * DEBIAN_RELESES.index(v))[-1]
+
+        else:
+            # compare "3.10" and "3.9" number by number
+            newest = sorted(
+                versions,
+                key=lambda v: [
+                    int(i) if i.isdigit() else 0
+                    for i in v.replace('x', '0').split('.')
+                ])[-1]
+        names[distro] = names['{}:{}'.format(distro, newest)]
+
+    return names
+
+
+def get_catalogue_file():
+    return join(get_plash_data(), 'cache', 'lxc-images.json')
+
+
+def load_cached():
+    try:
+        with open(get_catalogue_file()) as f:
+            catalogue = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if catalogue.get('url') != get_lxc_url():
+        return None
+    return catalogue
+
+
+def save(catalogue):
+    os.makedirs(os.path.dirname(get_catalogue_file()), exist_ok=True)
+    tmp_file = join(mkdtemp(), 'catalogue')
+    with open(tmp_file, 'w') as f:
+        json.dump(catalogue, f)
+    os.rename(tmp_file, get_catalogue_file())
+    os.rmdir(os.path.dirname(tmp_file))
+
+
+def fetch(cached):
+    '''
+    Fetch and parse the image listing, or only refresh the cached catalogue if
+    the server says it did not change
+    '''
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    lxc_url = get_lxc_url()
+    request = Request(lxc_url)
+    if cached and cached.get('etag'):
+        request.add_header('If-None-Match', cached['etag'])
+    if cached and cached.get('last_modified'):
+        request.add_header('If-Modified-Since', cached['last_modified'])
+    try:
+        response = urlopen(request)
+    except HTTPError as exc:
+        if cached and exc.code == 304:
+            cached['fetched'] = time.time()
+            return cached
+        raise
+    with response:
+        content = response.read().decode()
+        return {
+            'url': lxc_url,
+            'fetched': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'names': parse_catalogue(content, lxc_url),
+        }
+
+
+def get_images():
+    '''
+    Return a dict of image names and their urls. In offline mode
+    (PLASH_OFFLINE) only the cached catalogue is used. Exits the program if
+    there is no catalogue.
+    '''
+    from http.client import HTTPException
+    from urllib.error import URLError
+
+    cached = load_cached()
+    if os.environ.get('PLASH_OFFLINE'):
+        if not cached:
+            die('offline and no cached image list')
+        return cached['names']
+
+    ttl = float(os.environ.get('PLASH_LXC_TTL', DEFAULT_TTL))
+    if cached and time.time() - cached['fetched'] < ttl:
+        return cached['names']
+
+    try:
+        catalogue = fetch(cached)
+    except (URLError, HTTPException, OSError) as exc:
+        if not cached:
+            die('{}: {}'.format(get_lxc_url(), exc))
+        print(
+            'plash: using cached image list, fetching it failed: {}'.format(
+                exc),
+            file=sys.stderr)
+        return cached['names']
+    save(catalogue)
+    return catalogue['names']
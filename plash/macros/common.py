@@ -1,14 +1,12 @@
-import hashlib
+# import where needed, this module is imported by most evaluations
 import os
 import shlex
 import stat
-import subprocess
 import sys
-import uuid
 
-from plash.eval import (eval, hint, join_result, register_macro,
-                        shell_escape_args)
-from plash.utils import catch_and_die, hashstr, plash_map, run_write_read
+from plash.eval import (eval, eval_nested, eval_path, hint, join_result,
+                        record_input, register_macro, shell_escape_args)
+from plash.utils import catch_and_die, get_plash_data, mkdtemp, plash_map
 
 
 @register_macro()
@@ -42,6 +40,7 @@ def import_env(*envs):
         else:
             env, export_as = parts
         env_val = os.environ.get(env)
+        record_input('env', env, env_val)
         if env_val is not None:
             yield '{}={}'.format(export_as, shlex.quote(env_val))
 
@@ -49,6 +48,8 @@ def import_env(*envs):
 @register_macro()
 def invalidate_layer():
     'invalidate the cache of the current layer'
+    import uuid
+    record_input('volatile')
     return ': invalidate cache with {}'.format(uuid.uuid4())
 
 
@@ -75,10 +76,7 @@ def eval_file(file):
     'evaluate file content as expressions'
 
     fname = os.path.realpath(os.path.expanduser(file))
-    with open(fname) as f:
-        inscript = f.read()
-
-    sh = run_write_read(['plash-eval'], inscript.encode()).decode()
+    sh = eval_path(fname)
 
     # we remove an possibly existing newline
     # because else this macros would add one
@@ -93,35 +91,78 @@ def eval_string(stri):
     'evaluate expressions passed as string'
     tokens = shlex.split(stri)
 
-    return run_write_read(['plash-eval'], '\n'.join(tokens).encode()).decode()
+    return eval_nested('\n'.join(tokens).split('\n'))
 
 
 @register_macro()
 def eval_stdin():
     'evaluate expressions read from stdin'
-    cmd = ['plash-eval']
-    p = subprocess.Popen(cmd, stdin=sys.stdin, stdout=sys.stdout)
-    exit = p.wait()
-    if exit:
-        raise subprocess.CalledProcessError(exit, cmd)
+    record_input('volatile')
+    sh = eval_nested(line.rstrip('\n') for line in sys.stdin.readlines())
+    if sh.endswith('\n'):
+        return sh[:-1]
+    return sh
 
 
 @register_macro()
 def run_stdin():
     'run commands read from stdin'
+    record_input('volatile')
     return sys.stdin.read()
 
 
 class HashPaths:
     'recursively hash files and add as cache key'
 
+    # files are read in chunks, bigger trees are hashed by multiple threads
+    chunk_size = 1024 * 1024
+    parallel_min_files = 16
+
+    # don't trust the cached hash of files changed in the last seconds, they
+    # could change again without getting a new mtime
+    racy_seconds = 2
+
     def _list_all_files(self, dir):
         for (dirpath, dirnames, filenames) in os.walk(dir):
             for filename in filenames:
                 fname = os.sep.join([dirpath, filename])
                 yield fname
 
+    def _get_cache_file(self):
+        return os.path.join(get_plash_data(), 'cache', 'hash-path.json')
+
+    def _load_cache(self):
+        import json
+        try:
+            with open(self._get_cache_file()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        import json
+        try:
+            os.makedirs(
+                os.path.dirname(self._get_cache_file()), exist_ok=True)
+            tmp_file = os.path.join(mkdtemp(), 'cache')
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp_file, self._get_cache_file())
+            os.rmdir(os.path.dirname(tmp_file))
+        except OSError:
+            pass  # it's only a cache
+
+    def _hash_file(self, fname):
+        import hashlib
+        hasher = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
     def __call__(self, *paths):
+        import hashlib
+        import time
 
         collect_files = []
         for path in paths:
@@ -129,18 +170,55 @@ class HashPaths:
                 collect_files.extend(self._list_all_files(path))
             else:
                 collect_files.append(path)
+        collect_files.sort()
+
+        # the content hashes of unchanged files are taken from the cache
+        cache = self._load_cache()
+        digests = {}
+        cache_keys = {}
+        to_hash = []
+        now = time.time()
+        for fname in collect_files:
+            st = os.stat(fname)
+            cache_key = [st.st_ino, st.st_size, st.st_mtime_ns]
+            cached = cache.get(os.path.abspath(fname))
+            if cached and cached[:3] == cache_key:
+                digests[fname] = cached[3]
+            else:
+                to_hash.append(fname)
+            if now - st.st_mtime >= self.racy_seconds:
+                cache_keys[fname] = cache_key
+
+        if len(to_hash) >= self.parallel_min_files:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor() as executor:
+                digests.update(
+                    zip(to_hash, executor.map(self._hash_file, to_hash)))
+        else:
+            digests.update((f, self._hash_file(f)) for f in to_hash)
+
+        # keep the cached hashes of files in other paths
+        abs_paths = [os.path.abspath(path) for path in paths]
+        new_cache = {
+            fname: cached
+            for fname, cached in cache.items()
+            if not any(fname == path or fname.startswith(path + os.sep)
+                       for path in abs_paths)
+        }
+        for fname, cache_key in cache_keys.items():
+            new_cache[os.path.abspath(fname)] = cache_key + [digests[fname]]
+        if new_cache != cache:
+            self._save_cache(new_cache)
 
         hasher = hashlib.sha1()
-        for fname in sorted(collect_files):
+        for fname in collect_files:
             perm = str(oct(stat.S_IMODE(os.lstat(fname).st_mode))).encode()
-            with open(fname, 'rb') as f:
-                fread = f.read()  # well, no buffering?
             hasher.update(fname.encode())
             hasher.update(perm)
-
-            hasher.update(hashstr(fread).encode())
+            hasher.update(digests[fname].encode())
 
         hash = hasher.hexdigest()
+        record_input('hash-path', list(paths), hash)
         return ": hash: {}".format(hash)
 
 
@@ -3,7 +3,7 @@ import subprocess
 from functools import wraps
 
 from plash import utils
-from plash.eval import hint, register_macro
+from plash.eval import hint, record_input, register_macro
 
 
 def cache_container_hint(cache_key_templ):
@@ -16,6 +16,7 @@ def cache_container_hint(cache_key_templ):
             if not container_id:
                 container_id = func(*args)
                 utils.plash_map(cache_key, container_id)
+            record_input('map', cache_key, container_id)
             return hint('image', container_id)
 
         return wrapper
@@ -60,10 +61,10 @@ class MapDoesNotExist(Exception):
 @register_macro()
 def from_map(map_key):
     'use resolved map as image'
-    image_id = subprocess.check_output(['plash-map',
-                                        map_key]).decode().strip('\n')
+    image_id = utils.plash_map(map_key)
     if not image_id:
         raise MapDoesNotExist('map {} not found'.format(repr(map_key)))
+    record_input('map', map_key, image_id)
     return hint('image', image_id)
 
 
@@ -80,11 +81,11 @@ def from_(image):
 @cache_container_hint('github:{}')
 def from_github(user_repo_pair, file='plashfile'):
     "build and use a file (default 'plashfile') from github repo"
-    from urllib.request import urlopen
+    from plash.download import fetch
     url = 'https://raw.githubusercontent.com/{}/master/{}'.format(
         user_repo_pair, file)
     with utils.catch_and_die([Exception], debug=url):
-        resp = urlopen(url)
-    plashstr = resp.read()
+        with open(fetch(url), 'rb') as f:
+            plashstr = f.read()
     return utils.run_write_read(['plash', 'build', '--eval-stdin'],
                                 plashstr).decode().rstrip('\n')
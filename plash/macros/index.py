@@ -0,0 +1,90 @@
+'''
+The module and documentation of each builtin macro, so `plash eval` imports a
+macro module only when one of its macros is used and `plash help-macros` lists
+them without importing any. Generated by misc/gen-macro-index.
+'''
+
+MACROS = {
+    'A': ('plash.macros.shortcuts',
+          'alias for: --from alpine --apk [ARG1 [ARG2 [...]]]'),
+    'C': ('plash.macros.shortcuts',
+          'alias for: --from centos --yum [ARG1 [ARG2 [...]]]'),
+    'D': ('plash.macros.shortcuts',
+          'alias for: --from debian --apt [ARG1 [ARG2 [...]]]'),
+    'F': ('plash.macros.shortcuts',
+          'alias for: --from fedora --dnf [ARG1 [ARG2 [...]]]'),
+    'G': ('plash.macros.shortcuts',
+          'alias for: --from gentoo --emerge [ARG1 [ARG2 [...]]]'),
+    'R': ('plash.macros.shortcuts',
+          'alias for: --from archlinux --pacman [ARG1 [ARG2 [...]]]'),
+    'U': ('plash.macros.shortcuts',
+          'alias for: --from ubuntu --apt [ARG1 [ARG2 [...]]]'),
+    'add-apt-repository': ('plash.macros.packagemanagers',
+                           'install packages with add-apt-repository'),
+    'apk': ('plash.macros.packagemanagers',
+            'install packages with apk'),
+    'apt': ('plash.macros.packagemanagers',
+            'install packages with apt'),
+    'defpm': ('plash.macros.packagemanagers',
+              'define a new package manager'),
+    'dnf': ('plash.macros.packagemanagers',
+            'install packages with dnf'),
+    'emerge': ('plash.macros.packagemanagers',
+               'install packages with emerge'),
+    'entrypoint': ('plash.macros.common',
+                   'hint default command for this build'),
+    'entrypoint-script': ('plash.macros.common',
+                          'write lines to /entrypoint and hint it as default command'),
+    'eval-file': ('plash.macros.common',
+                  'evaluate file content as expressions'),
+    'eval-stdin': ('plash.macros.common',
+                   'evaluate expressions read from stdin'),
+    'eval-string': ('plash.macros.common',
+                    'evaluate expressions passed as string'),
+    'f': ('plash.macros.shortcuts',
+          'alias for: --from [ARG1 [ARG2 [...]]]'),
+    'from': ('plash.macros.froms',
+             'guess from where to take the image'),
+    'from-docker': ('plash.macros.froms',
+                    'use image from local docker'),
+    'from-github': ('plash.macros.froms',
+                    "build and use a file (default 'plashfile') from github repo"),
+    'from-id': ('plash.macros.froms',
+                'specify the image from an image id'),
+    'from-lxc': ('plash.macros.froms',
+                 'use images from images.linuxcontainers.org'),
+    'from-map': ('plash.macros.froms',
+                 'use resolved map as image'),
+    'from-url': ('plash.macros.froms',
+                 'import image from an url'),
+    'hash-path': ('plash.macros.common',
+                  'recursively hash files and add as cache key'),
+    'import-env': ('plash.macros.common',
+                   'import environment variables from host'),
+    'invalidate-layer': ('plash.macros.common',
+                         'invalidate the cache of the current layer'),
+    'l': ('plash.macros.shortcuts',
+          'alias for: --layer [ARG1 [ARG2 [...]]]'),
+    'layer': ('plash.macros.common',
+              'hint the start of a new layer'),
+    'npm': ('plash.macros.packagemanagers',
+            'install packages with npm'),
+    'pacman': ('plash.macros.packagemanagers',
+               'install packages with pacman'),
+    'pip': ('plash.macros.packagemanagers',
+            'install packages with pip'),
+    'pip3': ('plash.macros.packagemanagers',
+             'install packages with pip3'),
+    'run': ('plash.macros.common',
+            'directly emit shell script'),
+    'run-stdin': ('plash.macros.common',
+                  'run commands read from stdin'),
+    'write-file': ('plash.macros.common',
+                   'write lines to a file'),
+    'write-script': ('plash.macros.common',
+                     'write an executable (755) file to the filesystem'),
+    'x': ('plash.macros.shortcuts',
+          'alias for: --run [ARG1 [ARG2 [...]]]'),
+    'yum': ('plash.macros.packagemanagers',
+            'install packages with yum'),
+}
@@ -1,11 +1,53 @@
-from plash.eval import eval, register_macro, shell_escape_args
+from plash.eval import define_macro, eval, register_macro, shell_escape_args
 
+PACKAGE_MANAGERS = [
+    [
+        'apt',
+        'apt-get update',
+        'apt-get install -y {}',
+    ],
+    [
+        'add-apt-repository',
+        'apt-get install software-properties-common',
+        'run add-apt-repository -y {}',
+    ],
+    [
+        'apk',
+        'apk update',
+        'apk add {}',
+    ],
+    [
+        'yum',
+        'yum install -y {}',
+    ],
+    [
+        'dnf',
+        'dnf install -y {}',
+    ],
+    [
+        'pip',
+        'pip install {}',
+    ],
+    [
+        'pip3',
+        'pip3 install {}',
+    ],
+    [
+        'npm',
+        'npm install -g {}',
+    ],
+    [
+        'pacman',
+        'pacman -Sy --noconfirm {}',
+    ],
+    [
+        'emerge',
+        'emerge {}',
+    ],
+]
 
-@register_macro()
-def defpm(name, *lines):
-    'define a new package manager'
 
-    @register_macro(name, group='package managers')
+def package_manager_macro(name, lines):
     @shell_escape_args
     def package_manager(*packages):
         if not packages:
@@ -15,49 +57,15 @@ def defpm(name, *lines):
         return eval([['run'] + expanded_lines])
 
     package_manager.__doc__ = "install packages with {}".format(name)
+    return package_manager
+
+
+@register_macro()
+def defpm(name, *lines):
+    'define a new package manager'
+    define_macro(name, package_manager_macro(name, lines))
 
 
-eval([[
-    'defpm',
-    'apt',
-    'apt-get update',
-    'apt-get install -y {}',
-], [
-    'defpm',
-    'add-apt-repository',
-    'apt-get install software-properties-common',
-    'run add-apt-repository -y {}',
-], [
-    'defpm',
-    'apk',
-    'apk update',
-    'apk add {}',
-], [
-    'defpm',
-    'yum',
-    'yum install -y {}',
-], [
-    'defpm',
-    'dnf',
-    'dnf install -y {}',
-], [
-    'defpm',
-    'pip',
-    'pip install {}',
-], [
-    'defpm',
-    'pip3',
-    'pip3 install {}',
-], [
-    'defpm',
-    'npm',
-    'npm install -g {}',
-], [
-    'defpm',
-    'pacman',
-    'pacman -Sy --noconfirm {}',
-], [
-    'defpm',
-    'emerge',
-    'emerge {}',
-]])
+for name, *lines in PACKAGE_MANAGERS:
+    register_macro(
+        name, group='package managers')(package_manager_macro(name, lines))
@@ -0,0 +1,411 @@
+'''
+Optional index of the build data in an SQLite database. It lets plash answer
+questions about all containers and map keys without listing and reading one
+symlink for each of them. The symlinks in $PLASH_DATA/index and
+$PLASH_DATA/map stay the source of truth, the database is kept in sync with
+them and can always be regenerated with `plash reindex`, which also enables
+it.
+'''
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from os.path import join
+
+from plash.layout import get_parent
+from plash.utils import get_plash_data
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS containers (
+    id INTEGER PRIMARY KEY,
+    nodepath TEXT NOT NULL,
+    parent INTEGER NOT NULL,
+    size INTEGER,
+    created REAL,
+    last_used REAL,
+    build_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS containers_parent ON containers (parent);
+CREATE INDEX IF NOT EXISTS containers_nodepath ON containers (nodepath);
+CREATE TABLE IF NOT EXISTS maps (
+    key TEXT PRIMARY KEY,
+    container INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS maps_container ON maps (container);
+'''
+
+# how many of the largest files of a layer are listed in its manifest
+LARGEST_FILES = 10
+
+
+def get_db_file():
+    return join(get_plash_data(), 'metadata', 'index.sqlite')
+
+
+def is_enabled():
+    return os.path.exists(get_db_file())
+
+
+def connect():
+    import sqlite3
+    conn = sqlite3.connect(get_db_file(), timeout=60)
+    conn.executescript(SCHEMA)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(containers)')]
+    if 'build_seconds' not in columns:  # an index of an older version
+        with conn:
+            conn.execute(
+                'ALTER TABLE containers ADD COLUMN build_seconds REAL')
+    return conn
+
+
+@contextmanager
+def transaction():
+    'yields a connection in a transaction, or None if the index is disabled'
+    if not is_enabled():
+        yield None
+        return
+    conn = connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def compute_layer_stats(root):
+    '''
+    Walk the files of a layer and return its disk usage, its count of inodes
+    and a manifest with the disk usage of each top level entry and the largest
+    files. Hardlinked files are counted once. If some files could not be read,
+    like outside of the user namespace, `complete` is false.
+    '''
+    import heapq
+    root_stat = os.lstat(root)
+    seen = {root_stat.st_ino}
+    size = root_stat.st_blocks * 512
+    top_level = {}
+    largest = []
+    errors = []
+    for dirpath, dirnames, filenames in os.walk(root, onerror=errors.append):
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            except OSError as exc:
+                errors.append(exc)
+                continue
+            if st.st_ino in seen:
+                continue
+            seen.add(st.st_ino)
+            usage = st.st_blocks * 512
+            size += usage
+            relpath = os.path.relpath(path, root)
+            top = relpath.split('/', 1)[0]
+            top_level[top] = top_level.get(top, 0) + usage
+            if name in filenames:
+                heapq.heappush(largest, (usage, relpath))
+                if len(largest) > LARGEST_FILES:
+                    heapq.heappop(largest)
+    return {
+        'bytes': size,
+        'inodes': len(seen),
+        'complete': not errors,
+        'manifest': {
+            'top_level': top_level,
+            'largest': [[p, u] for u, p in sorted(largest, reverse=True)],
+        },
+    }
+
+
+def read_layer_file(nodepath):
+    try:
+        with open(join(nodepath, '_data', 'layer.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_layer_file(nodepath, stats):
+    stats_file = join(nodepath, '_data', 'layer.json')
+    with open(stats_file + '.tmp', 'w') as f:
+        json.dump(stats, f)
+    os.rename(stats_file + '.tmp', stats_file)
+
+
+def save_layer_stats(nodepath):
+    'record the stats of a layer in it, `plash add-layer` does that'
+    stats = compute_layer_stats(join(nodepath, '_data', 'root'))
+    recorded = read_layer_file(nodepath)
+    if recorded and 'build_seconds' in recorded:
+        stats['build_seconds'] = recorded['build_seconds']
+    write_layer_file(nodepath, stats)
+    return stats
+
+
+def save_build_seconds(container, nodepath, seconds):
+    '''
+    Record how long building a layer took, `plash gc` rather deletes layers
+    that are quick to build again.
+    '''
+    stats = read_layer_file(nodepath) or get_layer_stats(nodepath)
+    stats['build_seconds'] = round(seconds, 3)
+    write_layer_file(nodepath, stats)
+    with transaction() as conn:
+        if conn:
+            conn.execute(
+                'UPDATE containers SET build_seconds = ? WHERE id = ?',
+                (stats['build_seconds'], int(container)))
+
+
+def get_build_seconds(nodepath):
+    'how long building a layer took, None if it was not built by plash build'
+    stats = read_layer_file(nodepath)
+    return stats.get('build_seconds') if stats else None
+
+
+def get_layer_stats(nodepath):
+    '''
+    Return the stats recorded when the layer was added. They are computed and
+    recorded now for layers added by older versions and if the recorded ones
+    are not complete.
+    '''
+    stats = read_layer_file(nodepath)
+    if stats and stats.get('complete', True):
+        return stats
+    try:
+        return save_layer_stats(nodepath)
+    except OSError:
+        return compute_layer_stats(join(nodepath, '_data', 'root'))
+
+
+def get_layer_size(nodepath):
+    'disk usage of the files of one layer, without its child layers'
+    return get_layer_stats(nodepath)['bytes']
+
+
+def get_indexed_size(nodepath):
+    'the layer size to index, None if not all files could be read'
+    stats = get_layer_stats(nodepath)
+    return stats['bytes'] if stats.get('complete', True) else None
+
+
+def add_container(container, nodepath):
+    if not is_enabled():
+        return
+    size = get_indexed_size(nodepath)
+    with transaction() as conn:
+        if conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO containers '
+                '(id, nodepath, parent, size, created, build_seconds) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (int(container), nodepath, int(get_parent(nodepath)), size,
+                 time.time(), get_build_seconds(nodepath)))
+
+
+def remove_container(nodepath):
+    '''
+    Forget a removed container and the children nested in its directory (see
+    plash.layout). Also unlink their index and
+    map symlinks, so `plash clean` does not need to search for them. Returns
+    how many index and map symlinks were unlinked.
+    '''
+    plash_data = get_plash_data()
+    with transaction() as conn:
+        if not conn:
+            return 0, 0
+        ids = [
+            row[0] for row in conn.execute(
+                'SELECT id FROM containers WHERE nodepath = ? OR '
+                '(nodepath > ? AND nodepath < ?)',
+                (nodepath, nodepath + '/', nodepath + '0'))
+        ]
+        keys = []
+        for container in ids:
+            keys.extend(row[0] for row in conn.execute(
+                'SELECT key FROM maps WHERE container = ?', (container, )))
+            conn.execute('DELETE FROM maps WHERE container = ?',
+                         (container, ))
+            conn.execute('DELETE FROM containers WHERE id = ?',
+                         (container, ))
+    return (unlink_broken([join(plash_data, 'index', str(i)) for i in ids]),
+            unlink_broken([join(plash_data, 'map', k) for k in keys]))
+
+
+def unlink_broken(links):
+    count = 0
+    for link in links:
+        try:
+            if not os.path.exists(link):
+                os.unlink(link)
+                count += 1
+        except FileNotFoundError:
+            pass
+    return count
+
+
+def remove_missing():
+    '''
+    Forget containers whose data is gone and unlink their symlinks. Returns
+    how many index and map symlinks were unlinked.
+    '''
+    unlinked_indexes = unlinked_maps = 0
+    for nodepath in sorted(get_containers().values()):
+        if not os.path.exists(nodepath):
+            indexes, maps = remove_container(nodepath)
+            unlinked_indexes += indexes
+            unlinked_maps += maps
+    return unlinked_indexes, unlinked_maps
+
+
+def set_map(key, container):
+    with transaction() as conn:
+        if conn:
+            if container:
+                conn.execute(
+                    'INSERT OR REPLACE INTO maps (key, container) '
+                    'VALUES (?, ?)', (key, int(container)))
+            else:
+                conn.execute('DELETE FROM maps WHERE key = ?', (key, ))
+
+
+def touch(container):
+    'record that a container was used'
+    with transaction() as conn:
+        if conn:
+            conn.execute('UPDATE containers SET last_used = ? WHERE id = ?',
+                         (time.time(), int(container)))
+
+
+def get_containers():
+    'return a dict of all container ids and their nodepaths'
+    with transaction() as conn:
+        return {
+            str(container): nodepath
+            for container, nodepath in conn.execute(
+                'SELECT id, nodepath FROM containers')
+        }
+
+
+def get_maps():
+    'return a dict of all map keys and their container ids'
+    with transaction() as conn:
+        return {
+            key: str(container)
+            for key, container in conn.execute(
+                'SELECT key, container FROM maps')
+        }
+
+
+def get_layer_infos():
+    '''
+    return a dict of the container ids and their size, last use time and
+    build seconds
+    '''
+    with transaction() as conn:
+        return {
+            str(container): (size, last_used, build_seconds)
+            for container, size, last_used, build_seconds in conn.execute(
+                'SELECT id, size, last_used, build_seconds FROM containers')
+        }
+
+
+def get_parents():
+    'return a dict of all container ids and the ids of their parents'
+    with transaction() as conn:
+        return {
+            str(container): str(parent)
+            for container, parent in conn.execute(
+                'SELECT id, parent FROM containers')
+        }
+
+
+def get_descendants(containers):
+    '''
+    Return a dict of the containers stacked on the given containers, directly
+    or not, and their nodepaths and the ids of their parents.
+    '''
+    descendants = {}
+    with transaction() as conn:
+        pending = [int(c) for c in containers]
+        while pending:
+            for child, nodepath, parent in conn.execute(
+                    'SELECT id, nodepath, parent FROM containers '
+                    'WHERE parent = ?', (pending.pop(), )):
+                if str(child) not in descendants:
+                    descendants[str(child)] = (nodepath, str(parent))
+                    pending.append(child)
+    return descendants
+
+
+def get_map_keys(container):
+    'return the map keys pointing to a container'
+    with transaction() as conn:
+        return [
+            row[0] for row in conn.execute(
+                'SELECT key FROM maps WHERE container = ?', (int(container), ))
+        ]
+
+
+def rebuild():
+    '''
+    Regenerate the index from the symlinks in $PLASH_DATA/index and
+    $PLASH_DATA/map, creating it if it does not exist. Last use times are
+    kept.
+    '''
+    plash_data = get_plash_data()
+    containers = []
+    index_dir = join(plash_data, 'index')
+    for container in os.listdir(index_dir):
+        link = join(index_dir, container)
+        try:
+            nodepath = os.readlink(link)
+            created = os.lstat(link).st_mtime
+            os.stat(nodepath)
+        except OSError:
+            continue
+        if container != '0':
+            containers.append((container, nodepath, created))
+
+    maps = []
+    map_dir = join(plash_data, 'map')
+    for key in os.listdir(map_dir):
+        try:
+            nodepath = os.readlink(join(map_dir, key))
+            os.stat(nodepath)
+        except OSError:
+            continue
+        maps.append((key, int(os.path.basename(nodepath))))
+
+    # computing the sizes takes the longest, don't block others meanwhile
+    sizes = {
+        container: get_indexed_size(nodepath)
+        for container, nodepath, _ in containers
+    }
+    build_seconds = {
+        container: get_build_seconds(nodepath)
+        for container, nodepath, _ in containers
+    }
+
+    os.makedirs(os.path.dirname(get_db_file()), exist_ok=True)
+    conn = connect()
+    with conn:
+        last_used = dict(
+            conn.execute('SELECT id, last_used FROM containers '
+                         'WHERE last_used IS NOT NULL'))
+        conn.execute('DELETE FROM containers')
+        conn.execute('DELETE FROM maps')
+        conn.executemany(
+            'INSERT INTO containers '
+            '(id, nodepath, parent, size, created, last_used, build_seconds) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((int(container), nodepath, int(get_parent(nodepath)),
+              sizes[container], created, last_used.get(int(container)),
+              build_seconds[container])
+             for container, nodepath, created in containers))
+        conn.executemany('INSERT INTO maps (key, container) VALUES (?, ?)',
+                         maps)
+    conn.close()
@@ -0,0 +1,428 @@
+import json
+import os
+import shutil
+import uuid
+from os.path import join
+
+from plash import layout, metadata, unshare
+from plash.utils import (catch_and_die, die, get_plash_data, is_alive,
+                         mkdtemp, nodepath_or_die)
+
+# mount options are limited to the size of a memory page, also leave space for
+# the other options
+MAX_LOWERDIR_OPTION_LENGTH = 3072
+
+# the kernel mounts an overlay on top of at most one other overlay
+# (FILESYSTEM_MAX_STACK_DEPTH)
+MAX_STACK_DEPTH = 2
+
+
+def start_daemon(cmd, mountpoint, cwd=None):
+    '''
+    Run a fuse program in the foreground and wait until it mounted. It runs
+    until it is unmounted or `plash clean` stops it. Returns its pid, exits the
+    program on failure.
+    '''
+    import signal
+    import subprocess
+    import sys
+    import tempfile
+    import time
+
+    def preexec():
+        # fuse only handles signals that are not ignored
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # it outlives us, so it must not keep our stderr open for whoever reads it
+    with tempfile.TemporaryFile() as errors:
+        with catch_and_die([OSError], debug=os.path.basename(cmd[0])):
+            proc = subprocess.Popen(
+                cmd + ['-f'],
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=errors,
+                start_new_session=True,
+                preexec_fn=preexec)
+        while not os.path.ismount(mountpoint):
+            if proc.poll() is not None:
+                errors.seek(0)
+                sys.stderr.buffer.write(errors.read())
+                sys.stderr.flush()
+                die('{} failed with exit status {}'.format(
+                    os.path.basename(cmd[0]), proc.returncode))
+            time.sleep(0.01)
+    return proc.pid
+
+
+def mount_unionfs(lowerdir_list,
+                  mountpoint,
+                  changedir,
+                  max_depth=MAX_STACK_DEPTH):
+    # fuse mounts are not stacked, max_depth does not matter here
+    lowerdirs_str = ':'.join('{}=RO'.format(i) for i in lowerdir_list)
+    if changedir:
+        upperdir = os.path.join(changedir, 'data')
+        os.makedirs(upperdir, exist_ok=True)
+        upperdir_str = '{}=RW:'.format(upperdir)
+    else:
+        upperdir_str = ''
+
+    unionfs = shutil.which('unionfs') or shutil.which('unionfs-fuse') or die(
+        'unionfs-fuse seems not to be installed')
+    return [
+        start_daemon([
+            unionfs, '-o', 'cow', '{upperdir}{lowerdirs}'.format(
+                lowerdirs=lowerdirs_str, upperdir=upperdir_str), mountpoint
+        ], mountpoint)
+    ]
+
+
+def overlay(options, mountpoint, cwd):
+    '''
+    Mount an overlay filesystem with the kernel. If the kernel refuses to do
+    that, as it happens in user namespaces of older kernels, use fuse-overlayfs
+    that has the same on-disk format. Relative paths in `options` are relative
+    to `cwd`. Returns the pid of fuse-overlayfs or None.
+    '''
+    mountpoint = os.path.abspath(mountpoint)
+    old_cwd = os.open('.', os.O_RDONLY)
+    os.chdir(cwd)
+    try:
+        unshare.overlay(options, mountpoint)
+        return None
+    except OSError as exc:
+        error = exc
+    finally:
+        os.fchdir(old_cwd)
+        os.close(old_cwd)
+    fuse_overlayfs = shutil.which('fuse-overlayfs')
+    if not fuse_overlayfs:
+        die('mounting overlay failed: {}'.format(error.strerror))
+    return start_daemon([fuse_overlayfs, '-o', options, mountpoint],
+                        mountpoint, cwd)
+
+
+def mount_overlay(lowerdir_list,
+                  mountpoint,
+                  changedir,
+                  max_depth=MAX_STACK_DEPTH):
+    '''
+    Mount layers as overlay, stacking at most `max_depth` overlays on each
+    other. Returns the pids of fuse daemons.
+    '''
+
+    # paths relative to the layer dir keep the mount option short
+    layer_dir = join(get_plash_data(), 'layer')
+    lowerdir_list = [os.path.relpath(i, layer_dir) for i in lowerdir_list]
+    mountpoint = os.path.abspath(mountpoint)
+
+    daemons = []
+    collapsed_mountpoint = None
+    if len(':'.join(lowerdir_list)) > MAX_LOWERDIR_OPTION_LENGTH:
+
+        # Too many layers for one mount option, mount the lowest layers as a
+        # read only overlay and use that as the lowest layer. Only the lowest
+        # layers can be collapsed, whiteouts in a collapsed overlay don't hide
+        # files in the layers under it. So collapsing more layers would need
+        # a third overlay stacked on the other two, which the kernel refuses.
+        if max_depth < 2:
+            die('container has too many layers to be mounted ({}) on top of '
+                'another overlay, the kernel stacks overlays at most {} deep, '
+                'try `plash squash`'.format(
+                    len(lowerdir_list), MAX_STACK_DEPTH))
+        collapsed_mountpoint = mkdtemp()
+        length = len(collapsed_mountpoint)
+        top = 0
+        for lowerdir in lowerdir_list:
+            length += len(lowerdir) + 1
+            if length > MAX_LOWERDIR_OPTION_LENGTH:
+                break
+            top += 1
+        bottom_list = lowerdir_list[top:]
+        if len(':'.join(bottom_list)) > MAX_LOWERDIR_OPTION_LENGTH:
+            die('container has too many layers to be mounted ({}), they do '
+                'not fit in two overlays and the kernel stacks overlays at '
+                'most {} deep, try `plash squash`'.format(
+                    len(lowerdir_list), MAX_STACK_DEPTH))
+        daemons.append(
+            overlay('lowerdir=' + ':'.join(bottom_list), collapsed_mountpoint,
+                    layer_dir))
+        lowerdir_list = lowerdir_list[:top] + [collapsed_mountpoint]
+
+    if changedir:
+        workdir = os.path.abspath(os.path.join(changedir, 'work'))
+        upperdir = os.path.abspath(os.path.join(changedir, 'data'))
+        os.makedirs(workdir, exist_ok=True)
+        os.makedirs(upperdir, exist_ok=True)
+    else:
+        workdir = None
+        upperdir = None
+    daemons.append(
+        overlay(
+            'lowerdir={lowerdir}{workdir}{upperdir}'.format(
+                lowerdir=':'.join(lowerdir_list),
+                upperdir=',upperdir=' + upperdir if upperdir else '',
+                workdir=',workdir=' + workdir if workdir else ''),
+            mountpoint, layer_dir))
+
+    # the overlay keeps its own reference to the lower directories, so we
+    # don't need the collapsed mount anymore
+    if collapsed_mountpoint:
+        with catch_and_die([OSError]):
+            unshare.umount(collapsed_mountpoint, lazy=True)
+        os.rmdir(collapsed_mountpoint)
+    return [pid for pid in daemons if pid]
+
+
+def check_mount_option_part(dir):
+    if dir and not dir.replace('.', '').replace('/', '').replace(
+            '_', '').replace('-', '').isalnum():
+        die('cowardly dying: bad char(s) in unionfs-fuse/overlay arg: {}'.
+            format(dir))
+
+
+known_union_tastes = {'overlay': mount_overlay, 'unionfs-fuse': mount_unionfs}
+
+
+def get_mounts_dir():
+    return join(get_plash_data(), 'mounts')
+
+
+def get_start_time(pid):
+    'when a process started, to tell it apart from a later one with its pid'
+    with open('/proc/{}/stat'.format(pid)) as f:
+        return int(f.read().rsplit(')', 1)[1].split()[19])
+
+
+def save_mount_entry(entry, details):
+    with open(entry + '.tmp', 'w') as f:
+        json.dump(details, f)
+    os.rename(entry + '.tmp', entry)
+
+
+def read_mount_entry(entry):
+    '''
+    Return what a mount entry records, entries of older versions only tell
+    the mountpoint
+    '''
+    try:
+        return {'mountpoint': os.readlink(entry)}
+    except OSError:
+        pass
+    try:
+        with open(entry) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def register_mount(container, mountpoint, changedir=None):
+    '''
+    Note that this process mounts a container, so `plash gc` does not delete
+    it while it is used and `plash clean` can stop its fuse daemons once it is
+    not. The entry is stale when the process is gone and the mountpoint is not
+    mounted anymore, or if this process is in a mount namespace of its own,
+    once only the fuse daemons are left in that namespace. Returns the path of
+    the entry and what it records, add the daemons with `add_daemons` after
+    mounting.
+    '''
+    mounts_dir = get_mounts_dir()
+    os.makedirs(mounts_dir, exist_ok=True)
+    entry = join(mounts_dir, '{}_{}_{}_{}'.format(container, os.getsid(0),
+                                                  os.getpid(),
+                                                  uuid.uuid4().hex[:8]))
+    mntns = os.readlink('/proc/self/ns/mnt')
+    try:
+        private = mntns != os.readlink('/proc/{}/ns/mnt'.format(os.getppid()))
+    except OSError:
+        private = False
+    details = {
+        'container': container,
+        'mountpoint': os.path.abspath(mountpoint),
+        'changesdir': changedir and os.path.abspath(changedir),
+        'mntns': mntns,
+        'private': private,
+        'daemons': [],
+    }
+    save_mount_entry(entry, details)
+    return entry, details
+
+
+def add_daemons(entry, details, pids):
+    details['daemons'] = [[pid, get_start_time(pid)] for pid in pids]
+    save_mount_entry(entry, details)
+
+
+def get_namespaces():
+    'return a dict of the mount namespaces and the pids of their processes'
+    from collections import defaultdict
+    namespaces = defaultdict(set)
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            namespaces[os.readlink('/proc/{}/ns/mnt'.format(pid))].add(
+                int(pid))
+        except OSError:
+            continue  # gone or not ours
+    return namespaces
+
+
+def is_namespace_used(details, namespaces):
+    '''
+    Whether a process other than its fuse daemons is left in the mount
+    namespace of a mount made in a namespace of its own
+    '''
+    if not details.get('private'):
+        return False
+    daemons = {pid for pid, _ in details.get('daemons', [])}
+    return bool(namespaces.get(details['mntns'], set()) - daemons)
+
+
+def get_mounts(namespaces=None):
+    '''
+    Yield the container, whether it is in use and the path of each entry.
+    `namespaces` is what `get_namespaces` returns, it is read if needed and
+    not given.
+    '''
+    mounts_dir = get_mounts_dir()
+    try:
+        entries = os.listdir(mounts_dir)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        entry = join(mounts_dir, entry)
+        try:
+            container, sid, pid, _ = os.path.basename(entry).split('_')
+        except ValueError:
+            continue
+        details = read_mount_entry(entry)
+        mountpoint = details.get('mountpoint')
+        in_use = is_alive(sid, pid) or bool(
+            mountpoint and os.path.ismount(mountpoint))
+        if not in_use and details.get('private'):
+            if namespaces is None:
+                namespaces = get_namespaces()
+            in_use = is_namespace_used(details, namespaces)
+        yield container, in_use, entry
+
+
+def stop_daemons(entry):
+    '''
+    Terminate the fuse daemons of a mount entry that still run, they unmount
+    and exit then. Returns how many were terminated.
+    '''
+    import signal
+    details = read_mount_entry(entry)
+    count = 0
+    for pid, start_time in details.get('daemons', []):
+        try:
+            if get_start_time(pid) != start_time or os.readlink(
+                    '/proc/{}/ns/mnt'.format(pid)) != details['mntns']:
+                continue  # the pid belongs to another process by now
+            os.kill(pid, signal.SIGTERM)
+        except (OSError, ValueError, IndexError):
+            continue
+        count += 1
+    return count
+
+
+def release_mounts(pid):
+    '''
+    Stop the fuse daemons of the mounts of a process that exited and remove
+    their entries, so `plash clean` has nothing left to do for it. Mounts
+    still used by processes it left running are left to `plash clean`.
+    '''
+    mounts_dir = get_mounts_dir()
+    try:
+        entries = os.listdir(mounts_dir)
+    except FileNotFoundError:
+        return
+    namespaces = None
+    for entry in entries:
+        if entry.split('_')[2:3] != [str(pid)]:
+            continue
+        entry = join(mounts_dir, entry)
+        if namespaces is None:
+            namespaces = get_namespaces()
+        if is_namespace_used(read_mount_entry(entry), namespaces):
+            continue
+        stop_daemons(entry)
+        try:
+            os.unlink(entry)
+        except FileNotFoundError:
+            pass
+
+
+def record_use(container, nodepath):
+    'remember when a container was used last, for `plash gc`'
+    try:
+        os.utime(join(nodepath, '_data'))
+    except OSError:
+        pass
+    metadata.touch(container)
+
+
+def mount_warm(container, warm_root, mountpoint, changedir=None):
+    '''
+    Mount a container that is already mounted read only at warm_root, see
+    `plash warm`. Exits the program on failure.
+    '''
+    nodepath = nodepath_or_die(container)
+    with open(os.path.join(get_plash_data(), 'config', 'union_taste')) as f:
+        union_taste = f.read().rstrip('\n')
+    try:
+        mount_func = known_union_tastes[union_taste]
+    except KeyError:
+        die('unexpected union taste: {}'.format(union_taste))
+    check_mount_option_part(warm_root)
+    check_mount_option_part(changedir)
+    entry, details = register_mount(container, mountpoint, changedir)
+    if changedir:
+        # the warm root counts as one of the overlays the kernel can stack
+        add_daemons(entry, details,
+                    mount_func([warm_root], mountpoint, changedir))
+    else:
+        with catch_and_die([OSError]):
+            unshare.bind(warm_root, mountpoint)
+    record_use(container, nodepath)
+
+
+def mount_container(container,
+                    mountpoint,
+                    changedir=None,
+                    max_depth=MAX_STACK_DEPTH):
+    '''
+    Mount a container's filesystem with the configured union taste. With
+    overlay, at most `max_depth` overlays are stacked on each other. Exits the
+    program on failure.
+    '''
+    nodepath = nodepath_or_die(container)
+    plash_data = get_plash_data()
+    with catch_and_die([OSError], debug='layers'):
+        ancestors = layout.get_ancestors(nodepath)
+
+    # the nodepaths of the nested layout get long, use the symlinks for them
+    # because the arg size is limited
+    lowerdir_list = [
+        join(plash_data, 'index', os.path.basename(n), '_data', 'root')
+        if layout.is_nested(n) else join(n, '_data', 'root')
+        for n in ancestors
+    ] + [join(plash_data, 'layer', '0', '_data', 'root')]
+
+    with open(os.path.join(plash_data, 'config', 'union_taste')) as f:
+        union_taste = f.read().rstrip('\n')
+
+    try:
+        mount_func = known_union_tastes[union_taste]
+    except KeyError:
+        die('unexpected union taste: {}'.format(union_taste))
+
+    for l in lowerdir_list:
+        check_mount_option_part(l)
+    check_mount_option_part(changedir)
+    entry, details = register_mount(container, mountpoint, changedir)
+    add_daemons(entry, details,
+                mount_func(lowerdir_list, mountpoint, changedir, max_depth))
+    record_use(container, nodepath)
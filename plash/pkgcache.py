@@ -0,0 +1,131 @@
+'''
+Sharing the downloads of package managers between builds. If the file
+config/pkgcache exists, `plash create` bind mounts a directory under
+$PLASH_DATA/pkgcache over the download cache of each package manager in the
+container. The downloaded packages are then not part of the new layer and the
+next build installing them only unpacks them. The file can contain the maximum
+size of all caches, like "10G". After each build the least recently used files
+are deleted until the caches are under that size.
+'''
+
+import os
+from os.path import join
+
+from plash.utils import get_plash_data
+
+# the cache name and where the package manager keeps its downloads
+CACHE_DIRS = [
+    ('apt', '/var/cache/apt/archives'),
+    ('apk', '/etc/apk/cache'),
+    ('dnf', '/var/cache/dnf'),
+    ('yum', '/var/cache/yum'),
+    ('pacman', '/var/cache/pacman/pkg'),
+    ('emerge', '/var/cache/distfiles'),
+    ('pip', '/root/.cache/pip'),
+    ('npm', '/root/.npm'),
+]
+
+DEFAULT_MAX_SIZE = '10G'
+
+# file in the changes dir listing the mountpoints runopts had to create
+MOUNTPOINTS_FILE = 'mountpoints'
+
+
+def get_config_file():
+    return join(get_plash_data(), 'config', 'pkgcache')
+
+
+def get_cache_dir():
+    return join(get_plash_data(), 'pkgcache')
+
+
+def get_max_size():
+    'the configured maximum size of all caches, or None if not enabled'
+    from plash.gc import parse_size
+    try:
+        with open(get_config_file()) as f:
+            max_size = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return parse_size(max_size or DEFAULT_MAX_SIZE)
+
+
+def get_binds(host_mounts):
+    '''
+    Return the cache directories and where to mount them in a build container.
+    Cache dirs inside paths mounted from the host are left out, they already
+    are on the host.
+    '''
+    binds = []
+    for name, target in CACHE_DIRS:
+        if any(target == mount or target.startswith(mount.rstrip('/') + '/')
+               for mount in host_mounts):
+            continue
+        source = join(get_cache_dir(), name)
+        os.makedirs(source, exist_ok=True)
+        binds.append((source, target))
+    return binds
+
+
+def make_mountpoint(root, target):
+    '''
+    Create the directory target in root, with its missing parents. Returns the
+    created directories relative to root, the outermost first, or None if a
+    symlink is in the way, it could point anywhere on the host.
+    '''
+    created = []
+    path = root
+    for part in target.strip('/').split('/'):
+        path = join(path, part)
+        if os.path.islink(path):
+            return None
+        if not os.path.isdir(path):
+            os.mkdir(path, 0o755)
+            created.append(os.path.relpath(path, root))
+    return created
+
+
+def remove_mountpoints(changesdir):
+    'remove the mountpoints runopts created in the changes of a build'
+    try:
+        with open(join(changesdir, MOUNTPOINTS_FILE)) as f:
+            created = f.read().splitlines()
+    except FileNotFoundError:
+        return
+    for path in reversed(created):
+        try:
+            os.rmdir(join(changesdir, 'data', path))
+        except OSError:
+            pass  # the build put something there
+
+
+def evict(max_size):
+    '''
+    Delete the least recently used files of the caches until they use at most
+    max_size bytes. Returns how many bytes were freed.
+    '''
+    files = []
+    total = 0
+    for dirpath, _, filenames in os.walk(get_cache_dir()):
+        for filename in filenames:
+            path = join(dirpath, filename)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            size = st.st_blocks * 512
+            total += size
+            files.append((max(st.st_atime, st.st_mtime), size, path))
+    freed = 0
+    if total <= max_size:
+        return freed
+    files.sort()
+    for _, size, path in files:
+        try:
+            os.unlink(path)
+        except OSError:
+            continue  # gone or in a directory of a user in the container
+        freed += size
+        if total - freed <= max_size:
+            break
+    return freed
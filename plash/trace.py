@@ -0,0 +1,132 @@
+'''
+Timing of what plash does, enabled with `plash build --profile FILE` or by
+setting PLASH_TRACE to a file. Every traced phase appends one event with its
+wall time, the CPU time and disk I/O of its thread and some details like if the
+build cache was hit. The usage of waited for child processes is added as
+children_* fields, unless other threads traced phases at the same time, then it
+can't be told whose children they were. Nested plash
+processes append to the same file. Files ending with .json are written in the
+Chrome trace format (load them in chrome://tracing or ui.perfetto.dev), other
+files get one JSON object per line with the same fields.
+'''
+
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# the threads in traced phases and, for each open phase, the threads that were
+# in traced phases at the same time
+state = {'lock': threading.Lock(), 'threads': Counter(), 'overlaps': []}
+
+
+def get_trace_file():
+    return os.environ.get('PLASH_TRACE')
+
+
+def is_enabled():
+    return bool(get_trace_file())
+
+
+def get_usage(who):
+    'CPU seconds and bytes read and written, `who` is a resource.RUSAGE_*'
+    import resource
+    usage = resource.getrusage(who)
+    return (usage.ru_utime, usage.ru_stime, usage.ru_inblock * 512,
+            usage.ru_oublock * 512)
+
+
+def get_usages():
+    import resource
+    return (get_usage(resource.RUSAGE_THREAD),
+            get_usage(resource.RUSAGE_CHILDREN))
+
+
+def format_usage(before, after, prefix=''):
+    user, system, read, written = (a - b for b, a in zip(before, after))
+    return {
+        prefix + 'cpu_user': round(user, 6),
+        prefix + 'cpu_system': round(system, 6),
+        prefix + 'read_bytes': read,
+        prefix + 'written_bytes': written,
+    }
+
+
+def write_event(event):
+    '''
+    Append an event. Writers hold an flock while appending, so the opening
+    bracket of the Chrome format is written once.
+    '''
+    import fcntl
+    trace_file = get_trace_file()
+    chrome = trace_file.endswith('.json')
+    line = json.dumps(event, sort_keys=True) + (',\n' if chrome else '\n')
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if chrome and not os.fstat(fd).st_size:
+            line = '[\n' + line  # the closing bracket is optional
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def enter_thread():
+    '''
+    Note that this thread is in a traced phase, returns the set of threads in
+    traced phases while it runs.
+    '''
+    thread = threading.get_ident()
+    with state['lock']:
+        state['threads'][thread] += 1
+        for overlap in state['overlaps']:
+            overlap.add(thread)
+        overlap = set(state['threads'])
+        state['overlaps'].append(overlap)
+    return overlap
+
+
+def leave_thread(overlap):
+    thread = threading.get_ident()
+    with state['lock']:
+        state['overlaps'].remove(overlap)
+        state['threads'][thread] -= 1
+        if not state['threads'][thread]:
+            del state['threads'][thread]
+
+
+@contextmanager
+def span(name, **args):
+    '''
+    Trace the time spent in the with block. The yielded dict can be updated
+    with more details to record.
+    '''
+    if not is_enabled():
+        yield args
+        return
+    start = time.time()
+    overlap = enter_thread()
+    thread_before, children_before = get_usages()
+    try:
+        yield args
+    except BaseException:
+        args['failed'] = True
+        raise
+    finally:
+        thread_after, children_after = get_usages()
+        leave_thread(overlap)
+        args.update(format_usage(thread_before, thread_after))
+        if len(overlap) == 1:
+            args.update(
+                format_usage(children_before, children_after, 'children_'))
+        write_event({
+            'name': name,
+            'ph': 'X',
+            'ts': int(start * 1000000),
+            'dur': int((time.time() - start) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
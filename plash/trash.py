@@ -0,0 +1,187 @@
+'''
+Deleting containers in the background. A deleted container is renamed into
+$PLASH_DATA/trash, so it is gone at once for everybody else, and a worker
+process unlinks its files with many threads after the deleting command
+returned. Workers claim trash entries by renaming them to
+deleting_<sid>_<pid>_<name>, entries of crashed workers are detected like tmp
+dirs of crashed processes and taken over by the next worker.
+'''
+
+import os
+import queue
+import threading
+import time
+import uuid
+from os.path import join
+
+from plash.utils import get_plash_data, is_alive
+
+# unlinking waits for the disk and not for the interpreter
+THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def get_trash_dir():
+    return join(get_plash_data(), 'trash')
+
+
+def move_to_trash(path):
+    '''
+    Atomically move a file or directory into the trash, returns False if it
+    did not exist.
+    '''
+    trash_dir = get_trash_dir()
+    os.makedirs(trash_dir, exist_ok=True)
+    try:
+        os.rename(path, join(trash_dir, uuid.uuid4().hex))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def get_pending():
+    'return the trash entries not deleted yet and if a worker is deleting them'
+    try:
+        entries = os.listdir(get_trash_dir())
+    except FileNotFoundError:
+        return []
+    pending = []
+    for entry in entries:
+        if entry.startswith('deleting_'):
+            try:
+                _, sid, pid, _ = entry.split('_', 3)
+            except ValueError:
+                continue
+            pending.append((entry, is_alive(sid, pid)))
+        else:
+            pending.append((entry, False))
+    return pending
+
+
+def claim():
+    'take over trash entries that no living worker is deleting'
+    trash_dir = get_trash_dir()
+    claimed = []
+    for entry, being_deleted in get_pending():
+        if being_deleted:
+            continue
+        name = entry.split('_', 3)[-1]
+        claimed_path = join(trash_dir, 'deleting_{}_{}_{}'.format(
+            os.getsid(0), os.getpid(), name))
+        try:
+            os.rename(join(trash_dir, entry), claimed_path)
+        except FileNotFoundError:
+            continue  # another worker was faster
+        claimed.append(claimed_path)
+    return claimed
+
+
+def remove_tree(path, threads=THREADS):
+    '''
+    Delete a directory tree like shutil.rmtree, but unlink the files of many
+    directories at the same time. Files that are already gone are ignored.
+    '''
+    if not os.path.isdir(path) or os.path.islink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return
+
+    dirs = []
+    pending = queue.Queue()
+    errors = []
+
+    def work():
+        while True:
+            dir = pending.get()
+            if dir is None:
+                return
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                            pending.put(entry.path)
+                        else:
+                            try:
+                                os.unlink(entry.path)
+                            except FileNotFoundError:
+                                pass
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                errors.append(exc)
+            finally:
+                pending.task_done()
+
+    workers = [
+        threading.Thread(target=work, daemon=True) for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    pending.put(path)
+    pending.join()
+    for _ in workers:
+        pending.put(None)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+
+    # directories can only be removed when empty, so the deepest go first
+    dirs.sort(key=lambda d: d.count('/'), reverse=True)
+    for dir in dirs + [path]:
+        try:
+            os.rmdir(dir)
+        except FileNotFoundError:
+            pass
+
+
+def empty():
+    '''
+    Delete everything in the trash that no other worker is deleting, until
+    there is nothing left to claim.
+    '''
+    while True:
+        claimed = claim()
+        if not claimed:
+            break
+        for path in claimed:
+            try:
+                remove_tree(path)
+            except OSError:
+                pass  # leave it, `plash clean` will show it as pending
+
+
+def empty_in_background():
+    '''
+    Fork a worker emptying the trash. It leaves our session, so a process
+    waiting for this one does not wait for it.
+    '''
+    if not get_pending():
+        return
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            return
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        empty()
+    finally:
+        os._exit(0)
+
+
+def wait():
+    'help deleting the trash and wait for the other workers to finish'
+    own = 'deleting_{}_{}_'.format(os.getsid(0), os.getpid())
+    while True:
+        empty()
+        if not any(being_deleted and not entry.startswith(own)
+                   for entry, being_deleted in get_pending()):
+            break
+        time.sleep(0.1)
@@ -5,21 +5,26 @@
 import ctypes
 import errno
 import os
-import signal
-import atexit
-import sys
-from getpass import getuser
-from multiprocessing import Lock  # that takes way too long to load
-from subprocess import CalledProcessError, check_call
-
-from plash import utils
+from functools import lru_cache
+
 from plash.utils import catch_and_die, die, get_plash_data
 
 # I do believe this libc constants are stable.
 CLONE_NEWNS = 0x00020000
 CLONE_NEWUSER = 0x10000000
+MS_BIND = 4096
 MS_REC = 0x4000
 MS_PRIVATE = 1 << 18
+MNT_DETACH = 2
+
+_libc = None
+
+
+def get_libc():
+    global _libc
+    if not _libc:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    return _libc
 
 
 def die_with_errno(calling, extra=''):
@@ -28,18 +33,113 @@ def die_with_errno(calling, extra=''):
     die('calling {} returned {} {}'.format(calling, errno_str, extra))
 
 
-def get_subs(query_user, subfile):
-    'get subuids or subgids for a user'
+def mount(source, target, fstype=None, flags=0, data=None):
+    '''
+    Call mount(2), raises OSError on failure. Relative paths in `data` are
+    relative to the current working directory.
+    '''
+    encode = lambda s: os.fsencode(s) if s is not None else None
+    if get_libc().mount(
+            encode(source), encode(target), encode(fstype), flags,
+            encode(data)) == -1:
+        myerrno = ctypes.get_errno()
+        raise OSError(myerrno, os.strerror(myerrno), target)
+
+
+def bind(source, target):
+    'bind mount a file or directory, submounts are not included'
+    mount(source, target, None, MS_BIND)
+
+
+def rbind(source, target):
+    'bind mount a file or directory and all mounts under it'
+    mount(source, target, None, MS_BIND | MS_REC)
+
+
+def overlay(options, target):
+    'mount an overlay filesystem with mount options like lowerdir=a:b'
+    mount('overlay', target, 'overlay', 0, options)
+
+
+def umount(target, lazy=False):
+    if get_libc().umount2(os.fsencode(target),
+                          MNT_DETACH if lazy else 0) == -1:
+        myerrno = ctypes.get_errno()
+        raise OSError(myerrno, os.strerror(myerrno), target)
+
+
+def get_subs(uid, subfile):
+    'get all subuid or subgid ranges of a user, entries may use name or uid'
+    import pwd
+    owners = {str(uid)}
+    try:
+        owners.add(pwd.getpwuid(uid).pw_name)
+    except KeyError:
+        pass
+    ranges = []
     try:
         with open(subfile) as f:
-            read = f.readline()
-            user, start, count = read.split(':')
-            if user == query_user:
-                return int(start), int(count)
+            for line in f:
+                try:
+                    owner, start, count = line.strip().split(':')
+                    if owner in owners:
+                        ranges.append((int(start), int(count)))
+                except ValueError:
+                    continue  # comments, empty or broken lines
     except FileNotFoundError:
         pass
-    die('please configure a subgid/uid range for the user {} in /etc/subuid and /etc/subgid'.
-        format(repr(query_user)))
+    if not ranges:
+        die('please configure a subgid/uid range for the user {} in /etc/subuid and /etc/subgid'.
+            format(repr(max(owners, key=lambda o: not o.isdigit()))))
+    return ranges
+
+
+@lru_cache()
+def get_id_maps(uid, gid):
+    '''
+    Return the newuidmap and newgidmap arguments after the pid. We are root in
+    the namespace and all our subids follow in the order of the subid files.
+    '''
+    id_maps = []
+    for outside_id, subfile in ((uid, '/etc/subuid'), (gid, '/etc/subgid')):
+        id_map = ['0', str(outside_id), '1']
+        inside_id = 1
+        for start, count in get_subs(uid, subfile):
+            id_map += [str(inside_id), str(start), str(count)]
+            inside_id += count
+        id_maps.append(id_map)
+    return id_maps
+
+
+def spawn(cmd):
+    pid = os.fork()
+    if not pid:
+        try:
+            os.execvp(cmd[0], cmd)
+        finally:
+            os._exit(127)
+    return pid
+
+
+def map_ids(pid, read_fd, uid_map, gid_map):
+    '''
+    Runs forked before `pid` unshares its user namespace. Waits until it did
+    and maps its ids, both maps are written at the same time.
+    '''
+    if os.read(read_fd, 1) != b'x':
+        os._exit(1)  # the unsharing process died
+    children = [
+        spawn(['newuidmap', str(pid)] + uid_map),
+        spawn(['newgidmap', str(pid)] + gid_map)
+    ]
+    exit_status = 0
+    for child in children:
+        _, status = os.waitpid(child, 0)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 127:
+            exit_status = 127
+        elif status and not exit_status:
+            exit_status = 1
+    os._exit(exit_status)
 
 
 def unshare_if_user():
@@ -50,70 +150,69 @@ def unshare_if_user():
     if not os.getuid():
         return
     os.environ['PLASH_DATA'] = get_plash_data()
-    uid_start, uid_count = get_subs(getuser(), '/etc/subuid')
-    gid_start, gid_count = get_subs(getuser(), '/etc/subgid')
-
-    setup_user_map = [[
-        'newuidmap',
-        str(os.getpid()), '0',
-        str(os.getuid()), '1', '1',
-        str(uid_start),
-        str(uid_count)
-    ],
-                  [
-                      'newgidmap',
-                      str(os.getpid()), '0',
-                      str(os.getgid()), '1', '1',
-                      str(gid_start),
-                      str(gid_count)
-                  ]]
-
-    def prepare_unshared_proccess():
-        for cmd in setup_user_map:
-            try:
-                with catch_and_die([CalledProcessError],
-                                   debug='forked child'):
-                    check_call(cmd)
-            except FileNotFoundError as exc:
-                utils.die('newuidmap/newgidmap not found in PATH, please install it (package typically called `uidmap` or `shadow-utils`)')
-
-    # we need to call prepare_unshared_proccess
-    # from outside of the unshared process
-    lock = Lock()
-    lock.acquire()
+    uid_map, gid_map = get_id_maps(os.getuid(), os.getgid())
+
+    # the ids must be mapped from outside of the new user namespace, so a
+    # child forked before unsharing does it once we tell it through the pipe
+    pid = os.getpid()
+    read_fd, write_fd = os.pipe()
     child = os.fork()
     if not child:
-        lock.acquire()
-        prepare_unshared_proccess()
-        sys.exit(0)
-
-    @atexit.register
-    def kill_child():
-        os.kill(child, signal.SIGKILL)
-
-    # what the unshare binary does do
-    libc = ctypes.CDLL('libc.so.6', use_errno=True)
-    libc.unshare(CLONE_NEWUSER) != -1 or die_with_errno(
-        '`unshare(CLONE_NEWUSER)`',
-        '(maybe try `sysctl -w kernel.unprivileged_userns_clone=1`)')
+        os.close(write_fd)
+        map_ids(pid, read_fd, uid_map, gid_map)
+    os.close(read_fd)
+
+    # what the unshare binary does do, closing the pipe on failure ends the
+    # child
+    libc = get_libc()
+    try:
+        libc.unshare(CLONE_NEWUSER) != -1 or die_with_errno(
+            '`unshare(CLONE_NEWUSER)`',
+            '(maybe try `sysctl -w kernel.unprivileged_userns_clone=1`)')
+        os.write(write_fd, b'x')
+    finally:
+        os.close(write_fd)
     libc.unshare(CLONE_NEWNS) != -1 or die_with_errno('`unshare(CLONE_NEWNS)`')
-    libc.mount("none", "/", None, MS_REC | MS_PRIVATE,
-               None) != -1 or die_with_errno('mount')
+    with catch_and_die([OSError], debug='mount'):
+        mount('none', '/', None, MS_REC | MS_PRIVATE)
+
+    _, status = os.waitpid(child, 0)
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 127:
+        die('newuidmap/newgidmap not found in PATH, please install it (package typically called `uidmap` or `shadow-utils`)')
+    elif status:
+        die('mapping user ids with newuidmap/newgidmap failed')
 
-    atexit.unregister(kill_child)
 
-    lock.release()
-    pid, raw_exit_status = os.wait()
-    exit_status = raw_exit_status // 255
-    if exit_status:
-        sys.exit(1)
+def enter_namespaces(pid):
+    '''
+    Join the user namespace, if not root, and a copy of the mount namespace
+    of another process. Exits the program on failure
+    '''
+    libc = get_libc()
+    namespaces = [('mnt', CLONE_NEWNS)]
+    if os.getuid():
+        os.environ['PLASH_DATA'] = get_plash_data()
+        namespaces.insert(0, ('user', CLONE_NEWUSER))
+    for name, nstype in namespaces:
+        try:
+            fd = os.open('/proc/{}/ns/{}'.format(pid, name), os.O_RDONLY)
+        except OSError as exc:
+            die('could not open namespace of {}: {}'.format(pid, exc))
+        try:
+            libc.setns(fd, nstype) != -1 or die_with_errno(
+                '`setns({})`'.format(name))
+        finally:
+            os.close(fd)
+
+    # our mounts should not show up in the other process
+    libc.unshare(CLONE_NEWNS) != -1 or die_with_errno('`unshare(CLONE_NEWNS)`')
 
 
 def unshare_if_root():
     if os.getuid() or os.environ.get('PLASH_NO_UNSHARE'):
         return
-    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    libc = get_libc()
 
     libc.unshare(CLONE_NEWNS) != -1 or die_with_errno('`unshare(CLONE_NEWNS)`')
-    libc.mount("none", "/", None, MS_REC | MS_PRIVATE,
-               None) != -1 or die_with_errno('mounting')
+    with catch_and_die([OSError], debug='mount'):
+        mount('none', '/', None, MS_REC | MS_PRIVATE)
@@ -111,22 +111,41 @@ def filter_positionals(args):
 
 
 def handle_build_args():
-    import subprocess
     if len(sys.argv) >= 2 and sys.argv[1].startswith('-'):
+        from plash.build import build_cached
         cmd, args = filter_positionals(sys.argv[1:])
-        with catch_and_die([subprocess.CalledProcessError], silent=True):
-            out = subprocess.check_output(['plash-build'] + args)
-        container_id = out[:-1]
-        os.execlp(sys.argv[0], sys.argv[0], container_id, *cmd)
+        container_id, _ = build_cached(['args'] + args,
+                                       lambda: eval_or_die(args))
+
+        # continue as if the container id was passed by the user
+        sys.argv[1:] = [container_id] + cmd
+
+
+def eval_or_die(lines):
+    from plash import eval
+    with catch_and_die(
+        [eval.MacroNotFoundError, eval.MacroError, eval.EvalError]):
+        return eval.eval_lines(lines)
 
 
 def nodepath_or_die(container, allow_root_container=False):
-    import subprocess
+    container = str(container)
+    if not container.isdigit():
+        die("container id must be integer, got {}".format(repr(container)))
+
+    if container == '0' and not allow_root_container:
+        die("container must not be the special root container ('0')")
 
-    extra = [] if not allow_root_container else ['--allow-root-container']
-    with catch_and_die([subprocess.CalledProcessError], silent=True):
-        return subprocess.check_output(
-            ['plash-nodepath', str(container)] + extra, ).decode().strip('\n')
+    try:
+        with catch_and_die(
+            [OSError], ignore=FileNotFoundError, debug='readlink'):
+            nodepath = os.readlink(
+                os.path.join(get_plash_data(), 'index', container))
+        with catch_and_die([OSError], ignore=FileNotFoundError, debug='stat'):
+            os.stat(nodepath)
+    except FileNotFoundError:
+        die('no container {}'.format(repr(container)), exit=3)
+    return nodepath
 
 
 def get_default_shell(passwd_file):
@@ -143,13 +162,123 @@ def get_default_user_shell():
     return pwd.getpwuid(os.getuid()).pw_shell
 
 
-def plash_map(*args):
-    from subprocess import check_output
-    'thin wrapper around plash map'
-    out = check_output(['plash-map'] + list(args))
-    if out == '':
+def plash_map(key, container=None):
+    '''
+    Get, set or (with an empty container) delete a map key. This is what
+    `plash map` does, but without starting a new process.
+    '''
+    if os.sep in key:
+        die('map can not contain any {}'.format(repr(os.sep)))
+    map_file = join(get_plash_data(), 'map', key)
+
+    if container is None:
+        try:
+            nodepath = os.readlink(map_file)
+        except FileNotFoundError:
+            return None
+        if os.path.exists(nodepath):
+            return os.path.basename(nodepath)
         return None
-    return out.decode().strip('\n')
+
+    elif container == '':
+        with catch_and_die([OSError], debug='unlink'):
+            try:
+                os.unlink(map_file)
+            except FileNotFoundError:
+                pass
+        from plash import metadata
+        metadata.set_map(key, None)
+
+    else:
+        nodepath = nodepath_or_die(container)
+        with catch_and_die([OSError], debug='mkdtemp'):
+            tmpdir = mkdtemp()
+            os.symlink(nodepath, join(tmpdir, 'link'))
+
+            # rename will overwrite atomically the map key if it already exists,
+            # just symlink would not
+            os.rename(join(tmpdir, 'link'), map_file)
+            os.rmdir(tmpdir)
+        from plash import metadata
+        metadata.set_map(key, container)
+
+
+def add_layer(base_container, import_dir, container=None):
+    '''
+    Move a directory as new layer on top of a container and return the new
+    container id. This is what `plash add-layer` does. `container` is an id
+    reserved with `plash.layout.allocate_ids`, a new one is allocated if not
+    given.
+    '''
+    from plash import trace
+    with trace.span('add-layer', parent=base_container) as details:
+        container = _add_layer(base_container, import_dir, container)
+        details['container'] = container
+        if trace.is_enabled():
+            from plash.metadata import get_layer_size
+            details['layer_bytes'] = get_layer_size(
+                nodepath_or_die(container))
+    return container
+
+
+def _add_layer(base_container, import_dir, container):
+    from plash import layout
+    plash_data = get_plash_data()
+    nodepath_or_die(base_container, allow_root_container=True)
+
+    #
+    # prepare the node with the dir being imported
+    # this is the payload data we want to put in the builds folder later
+    #
+    prepared_new_node = mkdtemp()
+    os.chmod(prepared_new_node, 0o755)
+    os.mkdir(join(prepared_new_node, '_data'), 0o755)
+
+    # the next line will actually make the import_dir "disappear" for the user.
+    # the "root" folder will hold the access rights, user rights and maybe other meta
+    # data for the root folder ('/' after a chroot)
+    with catch_and_die([OSError], debug='rename'):
+        os.rename(import_dir, join(prepared_new_node, '_data', 'root'))
+    layout.save_parent(prepared_new_node, base_container)
+
+    from plash import dedup, metadata
+    if dedup.is_enabled():
+        from plash.unshare import unshare_if_user
+        unshare_if_user()  # to read and link files of all users
+        dedup.dedup_node(prepared_new_node)
+
+    # so `plash du` and `plash gc` don't need to walk the files later, without
+    # the user namespace they are only complete if we could read all files
+    metadata.save_layer_stats(prepared_new_node)
+
+    #
+    # register the node id
+    #
+    while True:
+        if not container:
+            container = layout.allocate_ids()[0]
+
+        # where the layer data will be saved
+        new_node_path = layout.get_layer_dir(container)
+
+        try:
+            # Register that we are using this new_node_path,
+            # so it does not gets lost in the 'build' folder tree if this program crashes.
+            os.symlink(new_node_path, join(plash_data, 'index', container))
+        except FileExistsError:
+            # taken by a version of plash without the locked counter
+            container = None
+            continue
+        break
+
+    #
+    #  put our new node with the import directory in the builds folder
+    #  with this we are so to speak saving the "real data"
+    #
+    os.rename(prepared_new_node, new_node_path)
+
+    metadata.add_container(container, new_node_path)
+    return container
 
 
 def assert_initialized():
@@ -169,8 +298,149 @@ def run_write_read(cmd, input):
     return p.stdout.read()
 
 
+def exec_subcommand(subcommand, *args):
+    '''
+    Replace the current program with a plash subcommand. Python subcommands
+    are run inside this interpreter, saving the startup time of a new one. Set
+    PLASH_NO_DISPATCH to exec a new process for every subcommand instead.
+    Raises FileNotFoundError if there is no such subcommand.
+    '''
+    libexec = join(os.path.dirname(os.path.abspath(__file__)), 'libexec')
+    binfile = join(libexec, 'plash-{}'.format(subcommand))
+    with open(binfile) as f:
+        shebang = f.readline()
+        source = shebang + f.read()
+    if os.environ.get('PLASH_NO_DISPATCH') or 'python' not in shebang:
+        os.execlp(binfile, binfile, *args)
+    code = compile(source, binfile, 'exec')
+    sys.argv = [binfile] + list(args)
+    exec(code, {'__name__': '__main__', '__file__': binfile})
+    sys.exit(0)
+
+
 def mkdtemp():
     import tempfile
     return tempfile.mkdtemp(
         dir=os.path.join(get_plash_data(), 'tmp'),
         prefix='plashtmp_{}_{}_'.format(os.getsid(0), os.getpid()))
+
+
+def is_alive(sid, pid):
+    'check if the process with this pid is still the one with this session id'
+    try:
+        real_sid = os.getsid(int(pid))
+    except ProcessLookupError:
+        return False
+    return str(sid) == str(real_sid)
+
+
+def is_stale_lock(lock_file):
+    '''
+    Check if the process holding a lock taken by older versions of `lock` is
+    gone. Returns None if there is no such lock.
+    '''
+    try:
+        owner = os.readlink(lock_file)
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return True  # not a symlink, so it's not a lock we took
+    try:
+        _, sid, pid = owner.split('_')
+    except ValueError:
+        return True
+    return not is_alive(sid, pid)
+
+
+def open_lock_file(lock_file):
+    '''
+    Open a lock file, creating it if it does not exist. Lock files of older
+    versions were symlinks and are replaced.
+    '''
+    import errno
+    while True:
+        try:
+            return os.open(lock_file, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                           0o644)
+        except OSError as exc:
+            if exc.errno != errno.ELOOP:
+                raise
+        if not is_stale_lock(lock_file):
+            # the lock of a running older version
+            import time
+            time.sleep(0.1)
+            continue
+        try:
+            os.unlink(lock_file)
+        except FileNotFoundError:
+            pass
+
+
+def is_same_file(fd, path):
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+@contextmanager
+def lock(name, on_wait=None):
+    '''
+    Hold a lock in $PLASH_DATA/lock, wait if another process holds it. The
+    lock is an flock on a file, so the kernel releases it when its holder
+    dies. `on_wait` is called once if we have to wait.
+    '''
+    import fcntl
+    lock_dir = join(get_plash_data(), 'lock')
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = join(lock_dir, name)
+    waited = False
+    while True:
+        fd = open_lock_file(lock_file)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not waited and on_wait:
+                on_wait()
+            waited = True
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        # `plash clean` removes lock files nobody holds, then we hold the lock
+        # of a file no other process can open anymore
+        if is_same_file(fd, lock_file):
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def remove_unused_lock(lock_file):
+    '''
+    Remove a lock file if no process holds its lock, return if it was
+    removed.
+    '''
+    import fcntl
+    if os.path.islink(lock_file):
+        if not is_stale_lock(lock_file):
+            return False
+        try:
+            os.unlink(lock_file)
+        except FileNotFoundError:
+            return False  # removed by another process
+        return True
+    try:
+        fd = os.open(lock_file, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if not is_same_file(fd, lock_file):
+            return False
+        os.unlink(lock_file)
+        return True
+    finally:
+        os.close(fd)
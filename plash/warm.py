@@ -0,0 +1,126 @@
+'''
+Warm containers are kept mounted read only by a daemon process in its own
+mount namespace. `plash run` joins that namespace and only needs to mount a
+changes dir on top, instead of setting up the namespaces and stacking all
+layers again. $PLASH_DATA/warm/CONTAINER links to the mountpoint of the
+daemon, a tmp dir whose name tells the session and process id of the daemon.
+'''
+
+import os
+import signal
+import sys
+from os.path import join
+
+from plash.utils import die, get_plash_data, is_alive, mkdtemp
+
+
+def get_warm_dir():
+    return join(get_plash_data(), 'warm')
+
+
+def parse_entry(entry):
+    'return the pid and mountpoint of a warm entry, or None if it is stale'
+    try:
+        warm_root = os.readlink(entry)
+        _, sid, pid, _ = os.path.basename(warm_root).split('_', 3)
+    except (OSError, ValueError):
+        return None
+    if not is_alive(sid, pid):
+        return None
+    return int(pid), warm_root
+
+
+def get(container):
+    'return the pid and mountpoint of the daemon of a warm container or None'
+    if os.environ.get('PLASH_NO_WARM'):
+        return None
+    return parse_entry(join(get_warm_dir(), str(container)))
+
+
+def get_all():
+    'yield the container, pid and mountpoint of all warm containers'
+    try:
+        containers = os.listdir(get_warm_dir())
+    except FileNotFoundError:
+        return
+    for container in containers:
+        parsed = parse_entry(join(get_warm_dir(), container))
+        if parsed:
+            yield (container, ) + parsed
+
+
+def remove_stale():
+    'unlink the entries of daemons that are gone, returns how many'
+    count = 0
+    try:
+        containers = os.listdir(get_warm_dir())
+    except FileNotFoundError:
+        return 0
+    for container in containers:
+        entry = join(get_warm_dir(), container)
+        if not parse_entry(entry):
+            try:
+                os.unlink(entry)
+                count += 1
+            except FileNotFoundError:
+                pass
+    return count
+
+
+def start(container):
+    '''
+    Start a daemon keeping a container mounted. Returns when the mount is
+    ready, exits the program if the daemon failed.
+    '''
+    from plash.mount import MAX_STACK_DEPTH, mount_container
+    from plash.unshare import unshare_if_root, unshare_if_user
+
+    if get(container):
+        return
+    read_fd, write_fd = os.pipe()
+    if os.fork():
+        os.close(write_fd)
+        with open(read_fd, 'rb') as f:
+            if f.read() != b'ready':
+                die('warming up {} failed'.format(container))
+        return
+
+    # the daemon
+    os.close(read_fd)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    try:
+        unshare_if_root()
+        unshare_if_user()
+        warm_root = mkdtemp()
+        # runs mount an overlay with their changes on top
+        mount_container(container, warm_root, max_depth=MAX_STACK_DEPTH - 1)
+        os.makedirs(get_warm_dir(), exist_ok=True)
+        tmp_link = warm_root + '.link'
+        os.symlink(warm_root, tmp_link)
+        os.rename(tmp_link, join(get_warm_dir(), str(container)))
+    except BaseException:
+        sys.stderr.flush()
+        os._exit(1)
+    os.write(write_fd, b'ready')
+    os.close(write_fd)
+    sys.stderr.flush()
+    os.dup2(devnull, 2)
+    while True:
+        signal.pause()
+
+
+def stop(container):
+    'stop the daemon of a warm container, returns False if there is none'
+    warm = get(container)
+    if not warm:
+        return False
+    pid, _ = warm
+    os.kill(pid, signal.SIGTERM)
+    try:
+        os.unlink(join(get_warm_dir(), str(container)))
+    except FileNotFoundError:
+        pass
+    return True